@@ -0,0 +1,139 @@
+
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#!/usr/bin/env python3
+
+#
+# Evaluates many checkpoints of the same metric (e.g. comet-ours) in a single process.
+# The data is loaded and tokenized only once and the next checkpoint is read from disk
+# in the background while the current one is being scored.
+# Outputs the same JSON lines as run_metric.py.
+#
+
+import argparse
+import glob
+import threading
+import utils
+import metrics
+from scipy.stats import kendalltau
+import json
+import time
+
+args = argparse.ArgumentParser()
+args.add_argument(
+    "checkpoints", nargs="+",
+    help="Checkpoint paths or (quoted) glob patterns, e.g. \"models/trained/finetune_datasize/*/*.ckpt\"."
+)
+args.add_argument("--metric", default="comet-ours")
+args.add_argument("--langs", default="all")
+args.add_argument("--domain", default="all")
+args.add_argument("--split", default="test")
+args.add_argument("--output", default=None, help="Append the JSON! lines also to this file.")
+args.add_argument(
+    "--score-cache", action="store_true",
+    help="Reuse segment scores stored in $ADAPTATION_ROOT/cache/scores/ and store the new ones there."
+)
+args, args_unknown = args.parse_known_args()
+
+args_unknown = dict(zip(args_unknown[:-1:2], args_unknown[1::2]))
+args_unknown = {
+    k.lstrip("-").replace("-", "_"): v
+    for k, v in args_unknown.items()
+}
+if args.score_cache:
+    metrics.cache.enable()
+
+checkpoints = [
+    f
+    for pattern in args.checkpoints
+    for f in sorted(glob.glob(pattern)) or [pattern]
+]
+
+if args.langs == "all":
+    langs = ["en-de", "en-ru", "zh-en"]
+elif args.langs == "total":
+    langs = utils.LANGS
+else:
+    langs = [args.langs]
+
+if args.domain == "all":
+    domains = ["bio", "general"]
+else:
+    domains = [args.domain]
+
+splits = {}
+for domain in domains:
+    for lang in langs:
+        data = utils.load_data(
+            kind="mqm", domain=domain,
+            langs=lang, split=args.split
+        )
+        splits[(domain, lang)] = (data, utils.transpose_keys(data))
+
+
+def prefetch(path, chunk_size=16*1024*1024):
+    """
+    Read the checkpoint once so that loading it later is served from the page cache.
+    """
+    with open(path, "rb") as f:
+        while f.read(chunk_size):
+            pass
+
+
+# tokenized batches, shared by all the checkpoints
+inputs = {}
+output_file = open(args.output, "a") if args.output else None
+
+for checkpoint_i, checkpoint in enumerate(checkpoints):
+    print(f"Running {checkpoint} ({checkpoint_i+1}/{len(checkpoints)})")
+    prefetch_thread = None
+    if checkpoint_i + 1 < len(checkpoints):
+        prefetch_thread = threading.Thread(target=prefetch, args=(checkpoints[checkpoint_i+1],), daemon=True)
+        prefetch_thread.start()
+
+    args_checkpoint = {"model_path": checkpoint} | args_unknown
+    for domain in domains:
+        for lang in langs:
+            data, data_transposed = splits[(domain, lang)]
+            lang1, lang2 = lang.split("-")
+            metric = metrics.get_pooled(
+                args.metric,
+                lang1=lang1, lang2=lang2, domain=domain,
+                # the tokenized batches are shared between the checkpoints only if they are prepared in this process
+                **({"num_workers": "0"} | args_checkpoint),
+            )
+            if hasattr(metric, "share_inputs") and not hasattr(metric, "inputs_shared"):
+                metric.share_inputs(inputs)
+                metric.inputs_shared = True
+
+            scores_true = [x["score"] for x in data]
+            scores = metric.predict(*data_transposed)
+            tau, _tau_p = kendalltau(scores_true, scores)
+            line_out = json.dumps({
+                "langs": lang, "metric": args.metric,
+                "domain": domain, "tau": tau,
+                "time": time.ctime(),
+                "args": args_checkpoint,
+            })
+            print("JSON!" + line_out)
+            if output_file:
+                output_file.write(line_out + "\n")
+                output_file.flush()
+
+    metrics.release(args.metric)
+    if prefetch_thread is not None:
+        prefetch_thread.join()
+
+if output_file:
+    output_file.close()
@@ -74,8 +74,73 @@ _METRICS = {
 }
 
 
+METRIC_SETS = {
+    # baselines reported in the paper, see scripts/04-misc/01-run_base_metrics.sh
+    "base": [
+        "bleu", "chrf", "ter", "meteor",
+        "comet", "comet-qe", "comet-da", "cometinho", "cometinho-da",
+        "unite-mup", "bleurt", "bertscore-xlmr", "bartscore",
+        "prism-ref", "prism-src",
+    ],
+    "string_matching": ["bleu", "chrf", "ter", "character", "meteor", "rougel", "nist_mt"],
+}
+
+# arguments which change with every language pair/domain and which should not trigger model reload
+_PAIR_KWARGS = {"lang1", "lang2", "domain"}
+# arguments which an already loaded metric applies in place (see `BaseMetric.reconfigure`)
+_INPLACE_KWARGS = {"encoder_cache_mb"}
+# arguments which only change how fast the scores are computed and not the scores themselves
+_EXECUTION_KWARGS = {
+    "threads", "batch_size", "num_workers", "autotune", "memory_mb", "max_tokens",
+    "embedding_cache", "embedding_cache_mb", "encoder_cache_mb", "check_parity",
+}
+_POOL = {}
+
+
+def _cache_signature(name, kwargs):
+    return (name, {k: v for k, v in kwargs.items() if k not in _EXECUTION_KWARGS})
+
+
 def get(name, **kwargs):
     if name in _METRICS:
-        return _METRICS[name](**kwargs)
+        metric = _METRICS[name](**kwargs)
+        # used by the persistent score cache
+        metric.cache_signature = _cache_signature(name, kwargs)
+        # used by the worker processes to get the same metric
+        metric.registry_kwargs = kwargs
+        return metric
     else:
         raise Exception(f"Unknown metric {name}")
+
+
+def get_pooled(name, **kwargs):
+    """
+    Same as `get` but keeps the loaded metrics for the whole process.
+    For a new language pair/domain only the per-pair state is rebound (see `BaseMetric.rebind`)
+    and the model is reloaded only if the metric can not be rebound.
+    """
+    pair_kwargs = {k: v for k, v in kwargs.items() if k in _PAIR_KWARGS}
+    inplace_kwargs = {k: v for k, v in kwargs.items() if k in _INPLACE_KWARGS}
+    key = (name, repr(sorted(
+        (k, v) for k, v in kwargs.items() if k not in _PAIR_KWARGS | _INPLACE_KWARGS
+    )))
+    if key not in _POOL or not _POOL[key].rebind(**pair_kwargs):
+        # drop the old instance first so that two models are not in memory at the same time
+        _POOL.pop(key, None)
+        _POOL[key] = get(name, **kwargs)
+    else:
+        _POOL[key].reconfigure(**inplace_kwargs)
+    _POOL[key].cache_signature = _cache_signature(name, kwargs)
+    _POOL[key].registry_kwargs = kwargs
+    return _POOL[key]
+
+
+def release(name):
+    """
+    Drop all pooled instances of a given metric so that the memory can be reused.
+    """
+    import gc
+
+    for key in [key for key in _POOL if key[0] == name]:
+        del _POOL[key]
+    gc.collect()
@@ -13,73 +13,112 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+from metrics_domain_adaptation import utils
 from .base import BaseMetric
+from . import cache
+from . import batching
+from . import encoder_cache
 from typing import List
 
 
 class BARTScoreMetric(BaseMetric):
-    import torch
+    uses_src = False
+
+    def __init__(
+        self, device="auto", max_length=1024, checkpoint='facebook/bart-large-cnn',
+        batch_size=8, max_tokens=4096, bidirectional=False, encoder_cache_mb=1024, **kwargs
+    ):
+        super().__init__()
 
-    def __init__(self, device='cuda:0', max_length=1024, checkpoint='facebook/bart-large-cnn'):
         # Set up model
+        import torch
         from transformers import BartTokenizer, BartForConditionalGeneration
+
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
         self.device = device
-        self.max_length = max_length
+        self.checkpoint = checkpoint
+        # all of these may come as strings from the command line
+        self.max_length = int(max_length)
+        self.batch_size = int(batch_size)
+        self.max_tokens = int(max_tokens)
+        # average of P(ref|tgt) and P(tgt|ref) instead of only P(ref|tgt)
+        self.bidirectional = utils.parse_bool(bidirectional)
         self.tokenizer = BartTokenizer.from_pretrained(checkpoint)
         self.model = BartForConditionalGeneration.from_pretrained(checkpoint)
         self.model.eval()
         self.model.to(device)
+        # the encoder inputs repeated across calls (e.g. the same outputs scored against references
+        # and, in the bidirectional mode, the references scored against many systems) are encoded only once
+        self.encoder_cache = encoder_cache.EncoderCache(max_bytes=int(encoder_cache_mb) * 1024 * 1024)
 
         # Set up loss used for scoring
-        self.loss_fct = self.torch.nn.NLLLoss(
+        self.loss_fct = torch.nn.NLLLoss(
             reduction='none', ignore_index=self.model.config.pad_token_id)
-        self.lsm = self.torch.nn.LogSoftmax(dim=1)
+        self.lsm = torch.nn.LogSoftmax(dim=1)
+
+    def fingerprint(self):
+        return cache.fingerprint_path(self.checkpoint)
 
-    def score(self, srcs, tgts, batch_size=8) -> List[int]:
-        """ Score a batch of examples """
+    def reconfigure(self, **kwargs):
+        if "encoder_cache_mb" in kwargs:
+            self.encoder_cache.resize(int(kwargs["encoder_cache_mb"]) * 1024 * 1024)
 
+    def score(self, srcs, tgts, batch_size=None, max_tokens=None) -> List[float]:
+        """ Score a batch of examples, sorted by length into batches of at most `max_tokens` tokens """
+
+        import torch
         import tqdm
-        score_list = []
-        for i in tqdm.tqdm(range(0, len(srcs), batch_size)):
-            src_list = srcs[i: i + batch_size]
-            tgt_list = tgts[i: i + batch_size]
-            with self.torch.no_grad():
-                encoded_src = self.tokenizer(
-                    src_list,
-                    max_length=self.max_length,
-                    truncation=True,
-                    padding=True,
-                    return_tensors='pt'
-                )
-                encoded_tgt = self.tokenizer(
-                    tgt_list,
-                    max_length=self.max_length,
-                    truncation=True,
-                    padding=True,
-                    return_tensors='pt'
-                )
-                src_tokens = encoded_src['input_ids'].to(self.device)
-                src_mask = encoded_src['attention_mask'].to(self.device)
+        from transformers.modeling_outputs import BaseModelOutput
+
+        batch_size = batch_size or self.batch_size
+        max_tokens = max_tokens or self.max_tokens
 
-                tgt_tokens = encoded_tgt['input_ids'].to(self.device)
-                tgt_mask = encoded_tgt['attention_mask']
+        # tokenize every unique sentence only once
+        texts = list(set(srcs) | set(tgts))
+        ids = dict(zip(texts, self.tokenizer(texts, max_length=self.max_length, truncation=True)['input_ids']))
+
+        batches = batching.length_batches(
+            [len(ids[src]) + len(ids[tgt]) for src, tgt in zip(srcs, tgts)],
+            max_tokens=max_tokens, max_batch_size=batch_size,
+        )
+        batch_scores = []
+        for batch in tqdm.tqdm(batches, disable=len(batches) <= 1):
+            src_list = [srcs[i] for i in batch]
+            src_ids_list = [ids[src] for src in src_list]
+            with torch.no_grad():
+                _src_tokens, src_mask = encoder_cache.pad(src_ids_list, self.tokenizer.pad_token_id)
+                tgt_tokens, tgt_mask = encoder_cache.pad([ids[tgts[i]] for i in batch], self.tokenizer.pad_token_id)
+                tgt_tokens = tgt_tokens.to(self.device)
                 tgt_len = tgt_mask.sum(dim=1).to(self.device)
 
+                encoder_states = self.encoder_cache.encode(
+                    self.model.get_encoder(), src_ids_list, keys=src_list,
+                    pad_token_id=self.tokenizer.pad_token_id, device=self.device,
+                )
                 output = self.model(
-                    input_ids=src_tokens,
-                    attention_mask=src_mask,
+                    encoder_outputs=BaseModelOutput(last_hidden_state=torch.nn.utils.rnn.pad_sequence(
+                        encoder_states, batch_first=True
+                    )),
+                    attention_mask=src_mask.to(self.device),
                     labels=tgt_tokens
                 )
                 logits = output.logits.view(-1, self.model.config.vocab_size)
                 loss = self.loss_fct(self.lsm(logits), tgt_tokens.view(-1))
                 loss = loss.view(tgt_tokens.shape[0], -1)
                 loss = loss.sum(dim=1) / tgt_len
-                curr_score_list = [-x.item() for x in loss]
-                score_list += curr_score_list
-        return score_list
+                batch_scores.append([-x.item() for x in loss])
+        return batching.unsort(batches, batch_scores)
 
     def _predict_single(self, src, tgt, ref):
-        return self.model.score(srcs=[tgt], tgts=[ref])[0]
+        return self._predict([src], [tgt], [ref])[0]
 
     def _predict(self, src, tgt, ref):
-        return self.model.score(srcs=tgt, tgts=ref)
+        # P(ref|tgt)
+        scores = self.score(srcs=tgt, tgts=ref)
+        if self.bidirectional:
+            # P(tgt|ref), a separate pass with the references as the encoder input
+            # (each direction encodes a different side, only repeated references hit the encoder cache)
+            scores_rev = self.score(srcs=ref, tgts=tgt)
+            scores = [(x + x_rev) / 2 for x, x_rev in zip(scores, scores_rev)]
+        return scores
@@ -14,9 +14,99 @@
 #  limitations under the License.
 
 import tqdm
+from . import cache
+
+def _source_hash(cls) -> str:
+    """
+    Hash of the source files of the metric class hierarchy and of the modules of this package they use
+    (e.g. batching), so that the cached scores are not reused after the scoring code changes.
+    """
+    import sys
+    import inspect
+    import hashlib
+
+    package = __name__.rsplit(".", 1)[0]
+    modules = {}
+    for klass in cls.__mro__:
+        module = sys.modules.get(klass.__module__)
+        if module is None or not module.__name__.startswith(package + "."):
+            continue
+        modules[module.__name__] = module
+        for value in vars(module).values():
+            value_module = inspect.getmodule(value)
+            if value_module is not None and value_module.__name__.startswith(package + "."):
+                modules[value_module.__name__] = value_module
+
+    source_hash = hashlib.sha256()
+    for name in sorted(modules):
+        with open(modules[name].__file__, "rb") as f:
+            source_hash.update(f.read())
+    return source_hash.hexdigest()
+
+
+def _get_worker_pool(workers):
+    """
+    New pool of worker processes, closed by the caller after scoring so that the metrics
+    loaded in the workers do not outlive it.
+    Workers are forked (and find the metric already in the copied pool) unless CUDA is initialized
+    in this process, which can not be forked safely.
+    """
+    import multiprocessing
+    import sys
+
+    context = "fork"
+    if "torch" in sys.modules and sys.modules["torch"].cuda.is_initialized():
+        context = "spawn"
+    return multiprocessing.get_context(context).Pool(workers)
+
+
+def _predict_shard(shard):
+    """
+    Runs in a worker process. The metric is taken from the registry with the same arguments
+    as in the main process, so a forked worker reuses the already loaded instance.
+    """
+    from . import get_pooled
+
+    name, kwargs, src, tgt, ref = shard
+    return get_pooled(name, **kwargs)._predict(src, tgt, ref)
 
 
 class BaseMetric():
+    # number of worker processes for _predict (e.g. run_metric.py --workers)
+    workers = 1
+    # reference-only metrics are deduplicated on (tgt, ref) instead of (src, tgt, ref)
+    uses_src = True
+
+    def rebind(self, **kwargs) -> bool:
+        """
+        Update the per-pair state (lang1, lang2, domain) of an already loaded metric.
+        Returns False if the metric can not be reused for the new pair and has to be reloaded.
+        Unless overriden, the metric does not depend on the language pair.
+        """
+        return True
+
+    def reconfigure(self, **kwargs):
+        """
+        Apply execution arguments (e.g. cache budget) to an already loaded metric from the pool.
+        Unless overriden, the metric has no such arguments.
+        """
+        pass
+
+    def shardable(self) -> bool:
+        """
+        Whether _predict can be split across worker processes.
+        Only metrics which score every segment separately on the CPU (_predict not overriden) are sharded,
+        batched model metrics would load a copy of the model in every worker.
+        """
+        return type(self)._predict is BaseMetric._predict
+
+    def fingerprint(self) -> str:
+        """
+        Identifies the underlying model (e.g. checkpoint path and modification time) for the score cache.
+        Unless overriden, the metric name and its arguments are enough.
+        """
+        return ""
+
     def predict(self, src, tgt, ref=None):
         """
         Wrapper for individual and batched queries.
@@ -24,8 +114,104 @@ class BaseMetric():
         if type(src) is str and type(tgt) is str:
             return self._predict([src], [tgt], [ref])
         else:
+            return self._predict_unique(src, tgt, ref)
+
+    def _predict_unique(self, src, tgt, ref):
+        """
+        Score every unique triplet only once and scatter the scores back to the original order.
+        """
+        if ref is None:
+            ref = []
+        ref = ref+[None]*(len(tgt)-len(ref))
+
+        unique = {}
+        index = []
+        for i, (src_line, tgt_line, ref_line) in enumerate(zip(src, tgt, ref)):
+            key = (src_line, tgt_line, ref_line) if self.uses_src else (tgt_line, ref_line)
+            index.append(unique.setdefault(key, i))
+        unique = list(unique.values())
+        print(f"Deduplication: {len(unique)} unique out of {len(tgt)} segments ({len(tgt)/max(1, len(unique)):.2f}x)")
+
+        src_unique = [src[i] for i in unique]
+        tgt_unique = [tgt[i] for i in unique]
+        ref_unique = [ref[i] for i in unique]
+        if cache.get_cache() is not None and hasattr(self, "cache_signature"):
+            scores_unique = self._predict_cached(src_unique, tgt_unique, ref_unique)
+        else:
+            scores_unique = self._predict_workers(src_unique, tgt_unique, ref_unique)
+
+        # some metrics return tensors or arrays
+        scores_unique = dict(zip(unique, [
+            score if score is None else float(score)
+            for score in scores_unique
+        ]))
+        return [scores_unique[i] for i in index]
+
+    def _predict_workers(self, src, tgt, ref):
+        """
+        Shard the segments across a pool of worker processes if requested.
+        The shards are contiguous and returned in order so the output is the same as of _predict.
+        """
+        # the workers take the metric from the registry
+        if self.workers <= 1 or not hasattr(self, "registry_kwargs") or not self.shardable() or len(tgt) <= 1:
             return self._predict(src, tgt, ref)
 
+        if ref is None:
+            ref = []
+        ref = ref+[None]*(len(tgt)-len(ref))
+        name, kwargs = self.cache_signature[0], self.registry_kwargs
+        # few shards per worker to balance segments of different lengths
+        shard_size = max(1, -(-len(tgt) // (self.workers * 4)))
+        shards = [
+            (name, kwargs, src[i:i+shard_size], tgt[i:i+shard_size], ref[i:i+shard_size])
+            for i in range(0, len(tgt), shard_size)
+        ]
+        scores = []
+        with _get_worker_pool(self.workers) as pool:
+            for scores_shard in tqdm.tqdm(
+                pool.imap(_predict_shard, shards),
+                total=len(shards)
+            ):
+                scores += list(scores_shard)
+        return scores
+
+    def _predict_cached(self, src, tgt, ref):
+        """
+        Look up the scores in the persistent cache and compute only the missing ones.
+        """
+        score_cache = cache.get_cache()
+        if ref is None:
+            ref = []
+        ref = ref+[None]*(len(tgt)-len(ref))
+        signature = cache.hash_signature(
+            name=self.cache_signature[0],
+            fingerprint=self.fingerprint(),
+            kwargs=self.cache_signature[1],
+            code=_source_hash(type(self)),
+        )
+        triplets = [
+            cache.hash_triplet(src_line, tgt_line, ref_line)
+            for src_line, tgt_line, ref_line in zip(src, tgt, ref)
+        ]
+        scores = score_cache.get_many(signature, triplets)
+        missing = [i for i, triplet in enumerate(triplets) if triplet not in scores]
+        print(f"Score cache: {len(triplets)-len(missing)} hits, {len(missing)} misses")
+
+        if missing:
+            scores_new = self._predict_workers(
+                [src[i] for i in missing],
+                [tgt[i] for i in missing],
+                [ref[i] for i in missing],
+            )
+            scores_new = {
+                triplets[i]: None if score is None else float(score)
+                for i, score in zip(missing, scores_new)
+            }
+            score_cache.put_many(signature, scores_new)
+            scores |= scores_new
+
+        return [scores[triplet] for triplet in triplets]
+
     def _predict(self, src, tgt, ref):
         """
         Unless overriden, simply call _predict_single for each triplet
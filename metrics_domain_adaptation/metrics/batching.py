@@ -0,0 +1,75 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+#
+# Length-aware batching shared by the neural metrics.
+# The segments are sorted by their token length and grouped into batches whose padded size
+# (batch size x longest segment) stays within a token budget, so that a single long abstract
+# does not turn most of a batch into padding. Use `unsort` to restore the original order.
+#
+
+from typing import List, Tuple
+
+
+def length_batches(lengths: List[int], max_tokens: int, max_batch_size: int = None) -> List[List[int]]:
+    """
+    Returns batches of indices into `lengths`, sorted from the shortest segments.
+    A segment longer than `max_tokens` forms a batch on its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # the batch is sorted so the current segment is the longest
+        if batch and (
+            lengths[i] * (len(batch)+1) > max_tokens or
+            (max_batch_size is not None and len(batch) >= max_batch_size)
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def length_buckets(lengths: List[int], max_tokens: int, max_batch_size: int = None) -> List[Tuple[int, List[int]]]:
+    """
+    Same as `length_batches` but for libraries which take a list of segments and a fixed batch size (COMET, BERTScore).
+    Returns (batch_size, indices) buckets so that only a few calls are needed: the batch sizes derived from the
+    token budget are rounded down to powers of two and capped at `max_batch_size` (which is not rounded).
+    Every batch of `batch_size` consecutive segments in a bucket fits in `max_tokens`.
+    """
+    buckets = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        batch_size = max(1, max_tokens // max(1, lengths[i]))
+        # round down to a power of two
+        batch_size = 2 ** (batch_size.bit_length()-1)
+        if max_batch_size is not None:
+            batch_size = min(batch_size, max_batch_size)
+        if not buckets or buckets[-1][0] != batch_size:
+            buckets.append((batch_size, []))
+        buckets[-1][1].append(i)
+    return buckets
+
+
+def unsort(index_groups: List[List[int]], score_groups: List[List]) -> List:
+    """
+    Scatter the scores of the batches (or buckets) back to the original order.
+    """
+    scores = [None] * sum(len(indices) for indices in index_groups)
+    for indices, scores_group in zip(index_groups, score_groups):
+        for i, score in zip(indices, scores_group):
+            scores[i] = score
+    return scores
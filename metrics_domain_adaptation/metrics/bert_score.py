@@ -13,15 +13,29 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import os
+import json
+import hashlib
+from metrics_domain_adaptation import utils
 from .base import BaseMetric
+from . import cache
+from . import batching
+from . import embedding_store
 
 
 class BERTScoreMetric(BaseMetric):
-    def __init__(self, model, **kwargs):
+    uses_src = False
+
+    def __init__(
+        self, model, max_tokens=16384, idf=False, embedding_cache="memory", embedding_cache_mb=1024, layers=None, **kwargs
+    ):
         super().__init__()
 
         from bert_score import BERTScorer
 
+        # padded tokens per batch, may come as a string from the command line
+        self.max_tokens = int(max_tokens)
+        self.idf = utils.parse_bool(idf)
         self.model_type = model
         self.lang2 = kwargs["lang2"]
 
@@ -30,11 +44,169 @@ class BERTScoreMetric(BaseMetric):
         else:
             self.model_path = None
 
+        # e.g. "9,12,17" from the command line, all the layers are taken from a single forward pass
+        if layers is not None:
+            if type(layers) is str:
+                layers = layers.split(",")
+            self.layers = [int(layer) for layer in layers]
+        else:
+            self.layers = None
+
         self.scorer = BERTScorer(
             lang=self.lang2,
             model_type=self.model_type,
             model_path=self.model_path,
             batch_size=128,
+            # the model is truncated after the last layer needed
+            **({"num_layers": max(self.layers)} if self.layers else {}),
+        )
+
+        # token embeddings of the references, which are the same for all the systems and domain/lang runs
+        assert embedding_cache in {"none", "memory", "disk"}
+        if embedding_cache != "none":
+            # the embeddings do not depend on the IDF weights
+            fingerprint = hashlib.sha256(
+                f"{cache.fingerprint_path(self.model_path)}:{self.model_type}:{self.layers or self.scorer.num_layers}".encode("utf-8")
+            ).hexdigest()
+            self.embedding_store = embedding_store.EmbeddingStore(
+                f"{utils.ROOT}/cache/embeddings/bertscore/{fingerprint}/"
+                if embedding_cache == "disk" else None,
+                # token embeddings of all the layers take a lot of memory
+                max_bytes=int(embedding_cache_mb) * 1024 * 1024,
+            )
+        else:
+            self.embedding_store = None
+        # IDF weights keyed by the hash of the references they are estimated from
+        self.idf_dicts = {}
+        # all the references of the current predict call (see `predict`)
+        self.idf_refs = None
+
+    def fingerprint(self):
+        fingerprint = cache.fingerprint_path(self.model_path)
+        if self.idf and self.idf_refs is not None:
+            # the scores depend on all the references the IDF is estimated from
+            fingerprint += ":idf-" + self._idf_key(self.idf_refs)
+        return fingerprint
+
+    def predict(self, src, tgt, ref=None):
+        """
+        With `idf`, the weights are estimated from all the references of the call before they are
+        deduplicated, looked up in the score cache or split into shards, so that the score of a segment
+        does not depend on those.
+        """
+        if self.idf and ref is not None:
+            self.idf_refs = [ref] if type(ref) is str else list(ref)
+        return super().predict(src, tgt, ref)
+
+    def rebind(self, **kwargs):
+        self.lang2 = kwargs["lang2"]
+        # the language is used only to select the default model and the baseline, which we both fix
+        self.scorer._lang = self.lang2
+        return True
+
+    @staticmethod
+    def _idf_key(ref):
+        return hashlib.sha256(json.dumps(sorted(set(ref)), ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _get_idf_dict(self, ref):
+        """
+        Uniform weights (except for [CLS] and [SEP]) as in BERTScorer or, with `idf`,
+        IDF estimated from the unique references (so that it does not depend on the number of systems).
+        """
+        from collections import defaultdict
+
+        tokenizer = self.scorer._tokenizer
+        if not self.idf:
+            idf_dict = defaultdict(lambda: 1.0)
+            idf_dict[tokenizer.sep_token_id] = 0
+            idf_dict[tokenizer.cls_token_id] = 0
+            return idf_dict
+
+        key = self._idf_key(ref)
+        ref = sorted(set(ref))
+        if key in self.idf_dicts:
+            return self.idf_dicts[key]
+
+        path = None
+        if self.embedding_store is not None and self.embedding_store.path is not None:
+            path = os.path.join(self.embedding_store.path, f"idf-{key}.json")
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                idf_saved = json.load(f)
+            idf_dict = defaultdict(lambda: idf_saved["default"])
+            idf_dict.update({int(k): v for k, v in idf_saved["weights"].items()})
+        else:
+            from bert_score.utils import get_idf_dict
+            import math
+
+            idf_dict = get_idf_dict(ref, tokenizer)
+            if path is not None:
+                with open(path, "w") as f:
+                    json.dump({
+                        # same as the default of get_idf_dict
+                        "default": math.log(len(ref) + 1),
+                        "weights": dict(idf_dict),
+                    }, f)
+        self.idf_dicts[key] = idf_dict
+        return idf_dict
+
+    def _embed(self, sentences, idf_dict, use_store):
+        """
+        Token embeddings and IDF weights of each unique sentence.
+        The embeddings have the shape (tokens, dim) or (tokens, len(layers), dim) with `layers`.
+        With `use_store`, the embeddings are taken from and added to the embedding store.
+        """
+        import torch
+        from bert_score.utils import get_bert_embedding, sent_encode
+
+        tokenizer = self.scorer._tokenizer
+        stats = {}
+        missing = []
+        for sentence in set(sentences):
+            ids = sent_encode(tokenizer, sentence)
+            idf = torch.tensor([idf_dict[i] for i in ids], dtype=torch.float)
+            embedding = None
+            if use_store:
+                embedding = self.embedding_store.get(embedding_store.hash_text(sentence))
+            if embedding is None:
+                missing.append((sentence, len(ids)))
+            stats[sentence] = (None if embedding is None else torch.from_numpy(embedding), idf)
+
+        batches = batching.length_batches(
+            [length for _, length in missing], max_tokens=self.max_tokens, max_batch_size=128,
+        )
+        for batch in batches:
+            sentences_batch = [missing[i][0] for i in batch]
+            embeddings, masks, _padded_idf = get_bert_embedding(
+                sentences_batch, self.scorer._model, tokenizer, idf_dict, device=self.scorer.device,
+                all_layers=self.layers is not None,
+            )
+            if self.layers is not None:
+                # hidden states of all layers (0 are the input embeddings)
+                embeddings = embeddings[:, :, self.layers, :]
+            embeddings = embeddings.cpu()
+            for sentence, embedding, mask in zip(sentences_batch, embeddings, masks.cpu()):
+                embedding = embedding[:int(mask.sum())]
+                stats[sentence] = (embedding, stats[sentence][1])
+                if use_store:
+                    self.embedding_store.put(embedding_store.hash_text(sentence), embedding.numpy())
+        return stats
+
+    @staticmethod
+    def _pad_stats(stats, device):
+        """
+        Same padding as in `bert_score.utils.bert_cos_score_idf`.
+        """
+        import torch
+        from torch.nn.utils.rnn import pad_sequence
+
+        embeddings, idfs = zip(*stats)
+        lens = torch.tensor([len(embedding) for embedding in embeddings], dtype=torch.long)
+        mask = torch.arange(int(lens.max())).expand(len(lens), int(lens.max())) < lens.unsqueeze(1)
+        return (
+            pad_sequence([embedding.to(device) for embedding in embeddings], batch_first=True, padding_value=2.0),
+            mask.to(device),
+            pad_sequence([idf.to(device) for idf in idfs], batch_first=True),
         )
 
     def _predict_single(self, src, tgt, ref):
@@ -43,8 +215,61 @@ class BERTScoreMetric(BaseMetric):
         )[2][0]
         return output
 
+    def _greedy_match(self, stats_tgt, stats_ref, tgt, ref, layer_i=None):
+        """
+        Returns (P, R, F) lists in the original order, with `layer_i` taken from multi-layer embeddings.
+        """
+        import torch
+        from bert_score.utils import greedy_cos_idf
+
+        if layer_i is not None:
+            stats_tgt = {k: (embedding[:, layer_i], idf) for k, (embedding, idf) in stats_tgt.items()}
+            stats_ref = {k: (embedding[:, layer_i], idf) for k, (embedding, idf) in stats_ref.items()}
+
+        device = next(self.scorer._model.parameters()).device
+        batches = batching.length_batches(
+            [max(len(stats_tgt[tgt_line][1]), len(stats_ref[ref_line][1])) for tgt_line, ref_line in zip(tgt, ref)],
+            max_tokens=self.max_tokens, max_batch_size=128,
+        )
+        batch_scores = []
+        with torch.no_grad():
+            for batch in batches:
+                P, R, F = greedy_cos_idf(
+                    *self._pad_stats([stats_ref[ref[i]] for i in batch], device),
+                    *self._pad_stats([stats_tgt[tgt[i]] for i in batch], device),
+                )
+                batch_scores.append(list(zip(P.cpu().tolist(), R.cpu().tolist(), F.cpu().tolist())))
+        return [list(x) for x in zip(*batching.unsort(batches, batch_scores))]
+
+    def _embed_pairs(self, tgt, ref):
+        if self.embedding_store is not None:
+            self.embedding_store.hits, self.embedding_store.misses = 0, 0
+
+        idf_dict = self._get_idf_dict(self.idf_refs if self.idf_refs is not None else ref)
+        # only the references are shared, the candidates are embedded every time
+        stats_ref = self._embed(ref, idf_dict, use_store=self.embedding_store is not None)
+        stats_tgt = self._embed(tgt, idf_dict, use_store=False)
+
+        if self.embedding_store is not None:
+            print(f"Embedding cache: {self.embedding_store.hits} hits, {self.embedding_store.misses} misses")
+            self.embedding_store.flush()
+        return stats_tgt, stats_ref
+
+    def predict_layers(self, src, tgt, ref):
+        """
+        Returns {layer: (P, R, F)} for all `layers` from a single forward pass.
+        """
+        self.idf_refs = list(ref) if self.idf else None
+        stats_tgt, stats_ref = self._embed_pairs(tgt, ref)
+        return {
+            layer: self._greedy_match(stats_tgt, stats_ref, tgt, ref, layer_i=layer_i)
+            for layer_i, layer in enumerate(self.layers)
+        }
+
     def _predict(self, src, tgt, ref):
-        output = self.scorer.score(
-            tgt, ref,
+        stats_tgt, stats_ref = self._embed_pairs(tgt, ref)
+        # with multiple layers, the score is F of the last one (see `predict_layers` for the rest)
+        return self._greedy_match(
+            stats_tgt, stats_ref, tgt, ref,
+            layer_i=len(self.layers)-1 if self.layers else None
         )[2]
-        return output
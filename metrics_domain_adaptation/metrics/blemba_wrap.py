@@ -13,33 +13,22 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-from .base import BaseMetric
+from .precomputed import PrecomputedMetric
 from metrics_domain_adaptation import utils
 
 
-class BLEMBAMetric(BaseMetric):
+class BLEMBAMetric(PrecomputedMetric):
     def __init__(self, mode, **kwargs):
         super().__init__()
-        import json
+        self.mode = mode
+        self.rebind(**kwargs)
+
+    def rebind(self, **kwargs):
         import os
 
-        fname = f"{utils.ROOT}/data/computed/blemba/{mode}/{kwargs['domain']}/{kwargs['lang1']}-{kwargs['lang2']}.jsonl"
+        fname = f"{utils.ROOT}/data/computed/blemba/{self.mode}/{kwargs['domain']}/{kwargs['lang1']}-{kwargs['lang2']}.jsonl"
         if not os.path.exists(fname):
-            fname = f"computed/blemba/{mode}/{kwargs['domain']}/{kwargs['lang1']}-{kwargs['lang2']}.jsonl"
-
-        self.data = [json.loads(x) for x in open(fname, "r")]
-        self.data = {
-            (x["src"], x["tgt"], x["ref"]): x["blemba_score"]
-            # reverse so that accidental duplicity doesn't override the score with None
-            for x in self.data[::-1]
-            if "blemba_score" in x and x["blemba_score"] is not None
-        }
+            fname = f"computed/blemba/{self.mode}/{kwargs['domain']}/{kwargs['lang1']}-{kwargs['lang2']}.jsonl"
 
-    def _predict_single(self, src, tgt, ref):
-        if (src, tgt, ref) not in self.data:
-            return 0
-            raise Exception(
-                f"Encountered example which is not in the data: {src}\n{tgt}\n{ref}"
-            )
-        else:
-            return self.data[(src, tgt, ref)]
+        self._bind(fname, "blemba_score")
+        return True
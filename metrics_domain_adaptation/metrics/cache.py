@@ -0,0 +1,142 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+#
+# Persistent segment-level score cache shared by all metrics.
+# Scores are stored in SQLite and keyed by the metric signature (name, model fingerprint, kwargs, hash of the metric code)
+# and by the hash of the (src, tgt, ref) triplet.
+# The cache is disabled unless `enable` is called (e.g. `run_metric.py --score-cache`).
+#
+
+import os
+import json
+import hashlib
+from typing import Dict, List
+
+_CACHE = None
+
+
+def enable(path=None):
+    global _CACHE
+    if path is None:
+        from metrics_domain_adaptation import utils
+        path = f"{utils.ROOT}/cache/scores/scores.sqlite"
+    _CACHE = ScoreCache(path)
+    return _CACHE
+
+
+def get_cache():
+    return _CACHE
+
+
+def fingerprint_path(path) -> str:
+    """
+    Identifies a model on disk by its path, size and modification time so that
+    overwritten checkpoints don't reuse old scores.
+    Paths which don't exist (e.g. HuggingFace hub names) are returned as they are.
+    """
+    if path is None or not os.path.exists(path):
+        return str(path)
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = sorted(
+            os.path.join(dirpath, f)
+            for dirpath, _, filenames in os.walk(path)
+            for f in filenames
+        )
+    return os.path.abspath(path) + ":" + hashlib.sha256("\n".join(
+        f"{f}:{os.stat(f).st_size}:{os.stat(f).st_mtime_ns}"
+        for f in files
+    ).encode("utf-8")).hexdigest()
+
+
+def hash_triplet(src, tgt, ref) -> str:
+    return hashlib.sha256(
+        json.dumps([src, tgt, ref], ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def hash_signature(name, fingerprint, kwargs, code="") -> str:
+    return hashlib.sha256(json.dumps(
+        {"name": name, "fingerprint": fingerprint, "kwargs": kwargs, "code": code},
+        sort_keys=True, default=str,
+    ).encode("utf-8")).hexdigest()
+
+
+class SQLiteCache():
+    """
+    Values stored in SQLite under (signature, key), the table can be shared by multiple processes.
+    Subclasses define the table name, the name of the key column and the value columns with their types.
+    """
+    # SQLite has a limit on the number of variables in a single query
+    CHUNK_SIZE = 500
+    TABLE = None
+    KEY = None
+    COLUMNS = {}
+
+    def __init__(self, path):
+        import sqlite3
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=600)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.TABLE} (signature TEXT, {self.KEY} TEXT, " +
+            "".join(f"{column} {column_type}, " for column, column_type in self.COLUMNS.items()) +
+            f"PRIMARY KEY (signature, {self.KEY}))"
+        )
+        self.conn.commit()
+
+    def get_rows(self, signature, keys: List[str]) -> Dict[str, tuple]:
+        """
+        Returns {key: values} for the keys which are stored under the signature.
+        """
+        keys = list(set(keys))
+        output = {}
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[i:i + self.CHUNK_SIZE]
+            output |= {
+                row[0]: row[1:]
+                for row in self.conn.execute(
+                    f"SELECT {self.KEY}, {', '.join(self.COLUMNS)} FROM {self.TABLE} "
+                    f"WHERE signature = ? AND {self.KEY} IN (" + ",".join(["?"] * len(chunk)) + ")",
+                    [signature] + chunk,
+                )
+            }
+        return output
+
+    def put_rows(self, signature, rows: Dict[str, tuple]):
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {self.TABLE} (signature, {self.KEY}, {', '.join(self.COLUMNS)}) "
+            f"VALUES (?, ?, {', '.join(['?'] * len(self.COLUMNS))})",
+            [(signature, key) + tuple(values) for key, values in rows.items()],
+        )
+        self.conn.commit()
+
+
+class ScoreCache(SQLiteCache):
+    TABLE = "scores"
+    KEY = "triplet"
+    COLUMNS = {"score": "REAL"}
+
+    def get_many(self, signature, triplets: List[str]) -> Dict[str, float]:
+        return {
+            triplet: score
+            for triplet, (score,) in self.get_rows(signature, triplets).items()
+        }
+
+    def put_many(self, signature, scores: Dict[str, float]):
+        self.put_rows(signature, {triplet: (score,) for triplet, score in scores.items()})
@@ -14,34 +14,291 @@
 #  limitations under the License.
 
 import os
+import time
+from metrics_domain_adaptation import utils
 from .base import BaseMetric
+from . import cache
+from . import batching
+from . import embedding_store
 
 
 class COMETMetric(BaseMetric):
-    def __init__(self, model_path, **kwargs):
+    # batch sizes tried by the autotune mode
+    AUTOTUNE_BATCH_SIZES = [8, 16, 32, 64, 128]
+
+    def __init__(
+        self, model_path, device="auto", threads=None, batch_size=64, num_workers=None,
+        autotune=False, memory_mb=None, max_tokens=8192, backend="fp32", embedding_cache="memory", **kwargs
+    ):
         super().__init__()
 
         from comet import load_from_checkpoint
         import torch
 
-        # speed-up inference
-        torch.set_float32_matmul_precision('medium')
+        assert backend in {"fp32", "int8"}
+        self.backend = backend
+        # all of these may come as strings from the command line
+        if device == "auto":
+            # quantized kernels are available only on CPU
+            device = "cuda" if torch.cuda.is_available() and backend == "fp32" else "cpu"
+        assert device in {"cpu", "cuda"}
+        if backend == "int8" and device != "cpu":
+            raise Exception("The int8 backend runs only on CPU, use device=cpu (or auto) or backend=fp32")
+        self.device = device
+        self.batch_size = int(batch_size)
+        self.num_workers = int(num_workers) if num_workers is not None else None
+        self.autotune = utils.parse_bool(autotune)
+        self.memory_mb = int(memory_mb) if memory_mb is not None else None
+        # padded tokens (of the longest of src/mt/ref) per batch
+        self.max_tokens = int(max_tokens)
+
+        if threads is not None:
+            torch.set_num_threads(int(threads))
+        if self.device == "cuda":
+            # speed-up inference, has no effect on CPU
+            torch.set_float32_matmul_precision('medium')
+
         if not os.path.exists(model_path):
             from comet import download_model
             model_path = download_model(model_path)
-        self.model = load_from_checkpoint(model_path)
+        self.model_path = model_path
+        if self.backend == "int8":
+            self.model = self._load_int8()
+        else:
+            self.model = load_from_checkpoint(model_path)
 
-    def _predict_single(self, src, tgt, ref):
-        output = self.model.predict(
-            {"src": src, "mt": tgt, "ref": ref},
-            batch_size=64, gpus=1, progress_bar=False,
+        # src and ref embeddings are shared by all the systems, see `_get_sentence_embedding`
+        assert embedding_cache in {"none", "memory", "disk"}
+        if embedding_cache != "none":
+            import hashlib
+
+            # quantized models have different embeddings
+            fingerprint = hashlib.sha256(f"{self.fingerprint()}:{self.backend}".encode("utf-8")).hexdigest()
+            self.embedding_store = embedding_store.EmbeddingStore(
+                f"{utils.ROOT}/cache/embeddings/comet/{fingerprint}/"
+                if embedding_cache == "disk" else None
+            )
+            self.memo_keys = set()
+            self._compute_sentence_embedding = self.model.get_sentence_embedding
+            self.model.get_sentence_embedding = self._get_sentence_embedding
+        else:
+            self.embedding_store = None
+
+    def fingerprint(self):
+        return cache.fingerprint_path(self.model_path)
+
+    def _load_int8(self):
+        """
+        Dynamic int8 quantization of all linear layers (encoder and estimator).
+        The quantized model is stored in $ADAPTATION_ROOT/cache/comet-int8/ keyed by the checkpoint fingerprint
+        and the torch and comet versions (the module is pickled) so that the fp32 checkpoint does not need to be loaded again.
+        """
+        import hashlib
+        import torch
+        import comet
+        from comet import load_from_checkpoint
+
+        fingerprint = hashlib.sha256(
+            f"{self.fingerprint()}:torch-{torch.__version__}:comet-{comet.__version__}".encode("utf-8")
+        ).hexdigest()
+        path = f"{utils.ROOT}/cache/comet-int8/{fingerprint}.pt"
+        if os.path.exists(path):
+            print(f"Loading quantized model from {path}")
+            return torch.load(path, weights_only=False)
+
+        model = torch.quantization.quantize_dynamic(
+            load_from_checkpoint(self.model_path), {torch.nn.Linear}, dtype=torch.qint8,
         )
-        return output["scores"][0]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so that a concurrent run never loads a partial model
+        torch.save(model, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return model
+
+    def _get_sentence_embedding(self, input_ids, attention_mask, *args, **kwargs):
+        """
+        Replaces the model's `get_sentence_embedding`.
+        Embeddings of the src and ref sentences (`memo_keys`) are taken from the store
+        and only the remaining rows (mt) are passed through the encoder.
+        """
+        import torch
+
+        if args or any(value is not None for value in kwargs.values()):
+            # token type ids etc. are not part of the key
+            return self._compute_sentence_embedding(input_ids, attention_mask, *args, **kwargs)
+
+        keys = [
+            embedding_store.hash_ids(input_ids_line[attention_mask_line.bool()].tolist())
+            for input_ids_line, attention_mask_line in zip(input_ids, attention_mask)
+        ]
+        stored = [
+            self.embedding_store.get(key) if key in self.memo_keys else None
+            for key in keys
+        ]
+        missing = [i for i, embedding in enumerate(stored) if embedding is None]
+        if len(missing) == len(keys):
+            output = self._compute_sentence_embedding(input_ids, attention_mask, *args, **kwargs)
+        else:
+            dim = next(embedding for embedding in stored if embedding is not None).shape[0]
+            output = torch.zeros((len(keys), dim), dtype=torch.float32, device=input_ids.device)
+            if missing:
+                # trim the padding of the remaining rows
+                max_len = int(attention_mask[missing].sum(dim=1).max())
+                output[missing] = self._compute_sentence_embedding(
+                    input_ids[missing, :max_len], attention_mask[missing, :max_len], *args, **kwargs
+                ).float()
+            for i, embedding in enumerate(stored):
+                if embedding is not None:
+                    output[i] = torch.from_numpy(embedding).to(output.device)
+
+        for i in missing:
+            if keys[i] in self.memo_keys:
+                self.embedding_store.put(keys[i], output[i].detach().float().cpu().numpy())
+        return output
+
+    def share_inputs(self, inputs: dict):
+        """
+        Memoizes the tokenized batches in `inputs` which can be shared between checkpoints with the same encoder
+        (see evaluate_checkpoints.py). Works only if the batches are prepared in this process (num_workers=0).
+        """
+        prepare_sample = self.model.prepare_sample
+        pretrained_model = self.model.hparams.pretrained_model
+
+        def _prepare_sample(sample, *args, **kwargs):
+            key = (pretrained_model, repr(args), repr(sorted(kwargs.items())), tuple(
+                (line.get("src"), line.get("mt"), line.get("ref")) for line in sample
+            ))
+            if key not in inputs:
+                inputs[key] = prepare_sample(sample, *args, **kwargs)
+            return inputs[key]
+
+        self.model.prepare_sample = _prepare_sample
+
+    def _model_predict(self, samples, batch_size, progress_bar):
+        return self.model.predict(
+            samples,
+            batch_size=batch_size,
+            gpus=1 if self.device == "cuda" else 0,
+            num_workers=self.num_workers,
+            progress_bar=progress_bar,
+        )["scores"]
+
+    @staticmethod
+    def _current_memory_mb():
+        # resident set size, unlike ru_maxrss it also goes down
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+    def _probe_memory_mb(self, probe, batch_size, baseline_mb):
+        """
+        Runs the probe and returns the peak memory above `baseline_mb` during it.
+        On CPU the resident set size is sampled from a background thread (Linux only).
+        """
+        import torch
+
+        if self.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+            self._model_predict(probe, batch_size=batch_size, progress_bar=False)
+            return torch.cuda.max_memory_allocated() / 1024 / 1024 - baseline_mb
+
+        import threading
+
+        peak = [self._current_memory_mb()]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.01):
+                peak[0] = max(peak[0], self._current_memory_mb())
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        try:
+            self._model_predict(probe, batch_size=batch_size, progress_bar=False)
+        finally:
+            done.set()
+            sampler.join()
+        return max(peak[0], self._current_memory_mb()) - baseline_mb
+
+    def _autotune(self, samples):
+        """
+        Time the first few batches with increasing batch sizes and keep the fastest one.
+        Stops at the first batch size which runs out of memory or for which the batch itself
+        (peak memory on top of the loaded model after a warm-up batch) exceeds `memory_mb`.
+        """
+        import torch
+
+        if self.device != "cuda" and self.memory_mb is not None and not os.path.exists("/proc/self/statm"):
+            print("Autotune: memory of the process can not be measured on this platform, ignoring --memory-mb")
+            self.memory_mb = None
+
+        # one-time costs (lazy initialization, allocator growth) are not attributed to the first batch size
+        self._model_predict(samples[:self.AUTOTUNE_BATCH_SIZES[0]], batch_size=self.AUTOTUNE_BATCH_SIZES[0], progress_bar=False)
+        if self.device == "cuda":
+            baseline_mb = torch.cuda.memory_allocated() / 1024 / 1024
+        elif self.memory_mb is not None:
+            baseline_mb = self._current_memory_mb()
+
+        timings = {}
+        for batch_size in self.AUTOTUNE_BATCH_SIZES:
+            probe = samples[:2*batch_size]
+            if len(probe) < 2*batch_size and timings:
+                # not enough data to tell the difference
+                break
+            try:
+                start = time.time()
+                if self.memory_mb is not None:
+                    memory_mb = self._probe_memory_mb(probe, batch_size, baseline_mb)
+                else:
+                    self._model_predict(probe, batch_size=batch_size, progress_bar=False)
+                timings[batch_size] = len(probe) / (time.time() - start)
+            except RuntimeError as e:
+                print(f"Autotune: batch size {batch_size} failed ({e})")
+                break
+            if self.memory_mb is not None and memory_mb > self.memory_mb:
+                print(f"Autotune: batch size {batch_size} needs {memory_mb:.0f}MB")
+                timings.pop(batch_size)
+                break
+
+        if timings:
+            self.batch_size = max(timings, key=timings.get)
+            print(f"Autotune: using batch size {self.batch_size} ({timings[self.batch_size]:.1f} segments/s)")
+        self.autotune = False
+
+    def _predict_single(self, src, tgt, ref):
+        return self._model_predict(
+            [{"src": src, "mt": tgt, "ref": ref}],
+            batch_size=1, progress_bar=False,
+        )[0]
 
     def _predict(self, src, tgt, ref):
-        output = self.model.predict([
+        samples = [
             {"src": src, "mt": tgt, "ref": ref}
             for src, tgt, ref in zip(src, tgt, ref)
-        ], batch_size=64, gpus=1, progress_bar=True,
-        )
-        return output["scores"]
+        ]
+        if self.autotune:
+            self._autotune(samples)
+
+        tokenizer = self.model.encoder.tokenizer
+        src_ids, tgt_ids, ref_ids = [tokenizer(texts)["input_ids"] for texts in [src, tgt, ref]]
+        lengths = [
+            max(len(src_ids_line), len(tgt_ids_line), len(ref_ids_line))
+            for src_ids_line, tgt_ids_line, ref_ids_line in zip(src_ids, tgt_ids, ref_ids)
+        ]
+        if self.embedding_store is not None:
+            self.embedding_store.hits, self.embedding_store.misses = 0, 0
+            # only src and ref are shared across the systems, mt would only fill the memory
+            self.memo_keys = {embedding_store.hash_ids(ids) for ids in src_ids + ref_ids}
+        buckets = batching.length_buckets(lengths, max_tokens=self.max_tokens, max_batch_size=self.batch_size)
+        bucket_scores = []
+        for batch_size, indices in buckets:
+            bucket_scores.append(self._model_predict(
+                [samples[i] for i in indices],
+                batch_size=batch_size, progress_bar=True,
+            ))
+
+        if self.embedding_store is not None:
+            print(
+                f"Embedding cache: {self.embedding_store.hits} hits, {self.embedding_store.misses} misses"
+            )
+            self.embedding_store.flush()
+        return batching.unsort([indices for _, indices in buckets], bucket_scores)
@@ -0,0 +1,139 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+#
+# Store of embeddings (numpy arrays of any shape) keyed by a string, e.g. the hash of the token ids.
+# Without a path the embeddings are kept only in RAM, optionally as an LRU cache bounded by `max_bytes`.
+# With a path they are appended to `data.bin` and located through `index.jsonl` (key, offset, shape).
+# `data.bin` is memory-mapped so that only the embeddings which are used are read from disk.
+# Multiple processes can share the same store, appends are serialized with a file lock.
+#
+
+import os
+import json
+import hashlib
+import collections
+import numpy as np
+
+
+def hash_ids(ids) -> str:
+    return hashlib.sha1(np.asarray(ids, dtype=np.int64).tobytes()).hexdigest()
+
+
+def hash_text(text) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore():
+    def __init__(self, path=None, dtype="float32", max_bytes=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        # embeddings not (yet) on disk, least recently used first
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        # only the RAM-only store evicts, on disk the embeddings in RAM are waiting for flush
+        self.max_bytes = max_bytes if path is None else None
+        # key -> (offset, shape) in data.bin
+        self.index = {}
+        self.index_end = 0
+        self.data = None
+        self.hits = 0
+        self.misses = 0
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+            self._read_index()
+
+    def _read_index(self, start=0):
+        """
+        Reads the index from byte `start` and returns the end position.
+        An incomplete last line (concurrent write) is left for the next read.
+        """
+        index_path = os.path.join(self.path, "index.jsonl")
+        if not os.path.exists(index_path):
+            return start
+        with open(index_path, "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                key, offset, shape = json.loads(line)
+                self.index[key] = (offset, tuple(shape))
+                start += len(line)
+        self.index_end = start
+        # data.bin might have grown
+        self.data = None
+        return start
+
+    def _mmap(self):
+        if self.data is None:
+            self.data = np.memmap(os.path.join(self.path, "data.bin"), dtype=self.dtype, mode="r")
+        return self.data
+
+    def __contains__(self, key):
+        return key in self.memory or key in self.index
+
+    def get(self, key):
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if key in self.index:
+            self.hits += 1
+            offset, shape = self.index[key]
+            return np.array(self._mmap()[offset:offset+int(np.prod(shape))]).reshape(shape)
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = np.asarray(value, dtype=self.dtype)
+        if self.max_bytes is not None and value.nbytes > self.max_bytes:
+            return
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key).nbytes
+        self.memory[key] = value
+        self.memory_bytes += value.nbytes
+        while self.max_bytes is not None and self.memory_bytes > self.max_bytes:
+            _, value_old = self.memory.popitem(last=False)
+            self.memory_bytes -= value_old.nbytes
+
+    def flush(self):
+        """
+        Appends the embeddings in RAM to the on-disk store (no-op without a path).
+        """
+        if self.path is None or not self.memory:
+            return
+        import fcntl
+
+        with open(os.path.join(self.path, "index.jsonl"), "ab") as f_index:
+            fcntl.flock(f_index, fcntl.LOCK_EX)
+            # pick up embeddings written by other processes
+            self._read_index(self.index_end)
+            with open(os.path.join(self.path, "data.bin"), "ab") as f_data:
+                offset = f_data.tell() // self.dtype.itemsize
+                lines = []
+                for key, value in self.memory.items():
+                    if key in self.index:
+                        continue
+                    f_data.write(value.tobytes())
+                    self.index[key] = (offset, value.shape)
+                    lines.append(json.dumps([key, offset, value.shape]) + "\n")
+                    offset += value.size
+            f_index.write("".join(lines).encode("utf-8"))
+            f_index.flush()
+            self.index_end = f_index.tell()
+            fcntl.flock(f_index, fcntl.LOCK_UN)
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.data = None
@@ -0,0 +1,96 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+#
+# Encoder hidden states shared between the scoring calls of the encoder-decoder metrics (PRISM2, BARTScore)
+# and the batching helpers used to compute them.
+#
+
+import collections
+
+
+def pad(ids_list, pad_token_id):
+    """
+    Right-pads the token ids into a batch tensor, returns the ids and the attention mask.
+    """
+    import torch
+
+    max_len = max(len(ids) for ids in ids_list)
+    ids = torch.full((len(ids_list), max_len), pad_token_id, dtype=torch.int64)
+    mask = torch.zeros((len(ids_list), max_len), dtype=torch.int64)
+    for i, ids_line in enumerate(ids_list):
+        ids[i, :len(ids_line)] = torch.tensor(ids_line, dtype=torch.int64)
+        mask[i, :len(ids_line)] = 1
+    return ids, mask
+
+
+class EncoderCache:
+    """
+    LRU cache of encoder hidden states (tensors) bounded by their total size in bytes.
+    The same sources and references are scored against the outputs of many systems.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.data = collections.OrderedDict()
+
+    @staticmethod
+    def _sizeof(value):
+        return value.element_size() * value.nelement()
+
+    def get(self, key):
+        if key not in self.data:
+            return None
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def put(self, key, value):
+        if key in self.data or self._sizeof(value) > self.max_bytes:
+            return
+        self.data[key] = value
+        self.size += self._sizeof(value)
+        self._evict()
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            _, value_old = self.data.popitem(last=False)
+            self.size -= self._sizeof(value_old)
+
+    def encode(self, encoder, ids_list, keys, pad_token_id, device):
+        """
+        Encoder hidden states (unpadded) of each input, computed only for inputs not in the cache.
+        """
+        states = [self.get(key) for key in keys]
+        # the same input can appear multiple times in a batch
+        missing = collections.defaultdict(list)
+        for i, (key, state) in enumerate(zip(keys, states)):
+            if state is None:
+                missing[key].append(i)
+
+        if missing:
+            ids_missing = [ids_list[idxs[0]] for idxs in missing.values()]
+            ids, mask = pad(ids_missing, pad_token_id)
+            hidden = encoder(input_ids=ids.to(device), attention_mask=mask.to(device))[0]
+            for (key, idxs), hidden_line, ids_line in zip(missing.items(), hidden, ids_missing):
+                # clone so that the padded batch tensor is not kept alive by the cache
+                hidden_line = hidden_line[:len(ids_line)].clone()
+                self.put(key, hidden_line)
+                for i in idxs:
+                    states[i] = hidden_line
+        return states
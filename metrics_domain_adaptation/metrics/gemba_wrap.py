@@ -13,29 +13,17 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-from .base import BaseMetric
+from .precomputed import PrecomputedMetric
 from metrics_domain_adaptation import utils
 
 
-class GEMBAMetric(BaseMetric):
+class GEMBAMetric(PrecomputedMetric):
     def __init__(self, signature, **kwargs):
         super().__init__()
-        import json
+        self.signature = signature
+        self.rebind(**kwargs)
 
-        fname = f"{utils.ROOT}/data/computed/gemba/{signature}/{kwargs['domain']}/{kwargs['lang1']}-{kwargs['lang2']}.jsonl"
-        self.data = [json.loads(x) for x in open(fname, "r")]
-        self.data = {
-            (x["src"], x["tgt"], x["ref"]): x["gpt_score"]
-            # reverse so that accidental duplicity doesn't override the score with None
-            for x in self.data[::-1]
-            if x["gpt_score"] is not None
-        }
-
-    def _predict_single(self, src, tgt, ref):
-        if (src, tgt, ref) not in self.data:
-            return 0
-            raise Exception(
-                f"Encountered example which is not in the data: {src}\n{tgt}\n{ref}"
-            )
-        else:
-            return self.data[(src, tgt, ref)]
+    def rebind(self, **kwargs):
+        fname = f"{utils.ROOT}/data/computed/gemba/{self.signature}/{kwargs['domain']}/{kwargs['lang1']}-{kwargs['lang2']}.jsonl"
+        self._bind(fname, "gpt_score")
+        return True
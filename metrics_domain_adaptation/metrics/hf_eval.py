@@ -17,6 +17,8 @@ from .base import BaseMetric
 
 
 class BLEURTMetric(BaseMetric):
+    uses_src = False
+
     def __init__(self, **kwargs):
         super().__init__()
 
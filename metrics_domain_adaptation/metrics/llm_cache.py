@@ -0,0 +1,69 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+#
+# Persistent prompt-level cache of LLM responses shared by all LLM-based scorers (e.g. BLEMBA, GEMBA).
+# Entries are stored in SQLite and keyed by the signature (endpoint/model id, prompt template id, sampling parameters)
+# and by the hash of the filled prompt.
+# Each entry keeps the raw generations and the score parsed from them.
+#
+
+import json
+import hashlib
+from typing import Dict, List, Tuple
+from . import cache
+
+
+def hash_prompt(prompt) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+def hash_signature(model, template, params) -> str:
+    return hashlib.sha256(json.dumps(
+        {"model": model, "template": template, "params": params},
+        sort_keys=True, default=str,
+    ).encode("utf-8")).hexdigest()
+
+
+class ResponseCache(cache.SQLiteCache):
+    TABLE = "responses"
+    KEY = "prompt"
+    COLUMNS = {"generations": "TEXT", "score": "REAL"}
+
+    def __init__(self, path=None):
+        if path is None:
+            from metrics_domain_adaptation import utils
+            path = f"{utils.ROOT}/cache/llm/responses.sqlite"
+        super().__init__(path)
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, signature, prompts: List[str]) -> Dict[str, Tuple[List[str], float]]:
+        """
+        Returns {prompt hash: (generations, score)} for the prompt hashes which are in the cache.
+        """
+        prompts = set(prompts)
+        output = {
+            prompt: (json.loads(generations), score)
+            for prompt, (generations, score) in self.get_rows(signature, list(prompts)).items()
+        }
+        self.hits += len(output)
+        self.misses += len(prompts) - len(output)
+        return output
+
+    def put_many(self, signature, responses: Dict[str, Tuple[List[str], float]]):
+        self.put_rows(signature, {
+            prompt: (json.dumps(generations, ensure_ascii=False), score)
+            for prompt, (generations, score) in responses.items()
+        })
@@ -0,0 +1,113 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+#
+# Asynchronous client for the `/generate/` endpoint of transformers-bloom-inference (see scripts/11-bloom/).
+# One pooled session is kept for the whole run, at most `concurrency` requests are in flight
+# and every request carries up to `batch_size` prompts.
+# Connection errors, timeouts and 429/5xx responses are retried with exponential backoff.
+#
+
+import asyncio
+import random
+import time
+from typing import List
+
+
+class GenerateClient():
+    def __init__(self, url, concurrency=4, batch_size=8, max_retries=8, backoff=1.0, max_backoff=60.0, timeout=None):
+        self.url = url.rstrip("/")
+        self.concurrency = int(concurrency)
+        self.batch_size = int(batch_size)
+        self.max_retries = int(max_retries)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.timeout = timeout
+        self.session = None
+        self.semaphore = None
+        # statistics of the whole run
+        self.requests = 0
+        self.retries = 0
+        self.latencies = []
+
+    async def __aenter__(self):
+        import aiohttp
+
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        self.session = None
+
+    async def post(self, body) -> dict:
+        """
+        Sends a single request and returns the parsed response, retrying failures with backoff.
+        """
+        import aiohttp
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    time_start = time.perf_counter()
+                    async with self.session.post(self.url + "/generate/", json=body) as response:
+                        if 400 <= response.status < 500 and response.status != 429:
+                            # other client errors are not going to be fixed by retrying
+                            raise Exception(self._client_error(body, response.status, await response.text()))
+                        if response.status < 400:
+                            response = await response.json()
+                            self.requests += 1
+                            self.latencies.append(time.perf_counter() - time_start)
+                            return response
+                        error = f"HTTP {response.status}"
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                error = repr(e)
+
+            if attempt == self.max_retries:
+                raise Exception(f"Request to {self.url} failed after {self.max_retries} retries: {error}")
+            self.retries += 1
+            # full jitter so that the failed requests do not come back all at once
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+            print(f"Request failed ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def _client_error(self, body, status, text) -> str:
+        message = f"Request to {self.url} rejected with HTTP {status}: {text[:500]}"
+        if len(body["text"]) > 1:
+            # most likely the transformers-bloom-inference MAX_BATCH_SIZE (see 04-launch_server.sh)
+            message += (
+                f"\nThe request had {len(body['text'])} prompts, "
+                f"if that is more than the server batch capacity (MAX_BATCH_SIZE), lower the batch size (--batch-size)."
+            )
+        return message
+
+    async def generate(self, prompts: List[str], field="text", **generate_kwargs) -> List:
+        """
+        Generations (or other per-prompt `field` of the response, e.g. top_logprobs) for all the prompts,
+        split into requests of `batch_size` prompts which are sent concurrently.
+        """
+        responses = await asyncio.gather(*[
+            self.post({"text": prompts[i:i+self.batch_size]} | generate_kwargs)
+            for i in range(0, len(prompts), self.batch_size)
+        ])
+        if any(field not in response for response in responses):
+            raise Exception(
+                f"The server at {self.url} does not return `{field}` for {generate_kwargs} "
+                f"(only {sorted(responses[0].keys())})"
+            )
+        return [output for response in responses for output in response[field]]
@@ -0,0 +1,43 @@
+
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+
+#
+# Base of the metrics whose segment scores are precomputed elsewhere (GEMBA, BLEMBA) and only looked up
+# in the JSONL output files through the score index.
+#
+
+from .base import BaseMetric
+from . import cache
+from . import score_index
+
+
+class PrecomputedMetric(BaseMetric):
+    def fingerprint(self):
+        # the precomputed scores are appended to over time
+        return cache.fingerprint_path(self.fname)
+
+    def _bind(self, fname, score_key):
+        self.fname = fname
+        # compiled once into a hash-keyed index instead of loading the whole file
+        self.index = score_index.ScoreIndex(fname, score_key)
+
+    def _predict(self, src, tgt, ref):
+        self.index.hits, self.index.misses = 0, 0
+        scores = self.index.lookup(src, tgt, ref)
+        print(f"Score index: {self.index.hits} hits, {self.index.misses} misses")
+        # examples which are not in the data are scored 0
+        return [0 if score is None else score for score in scores]
+
+    def _predict_single(self, src, tgt, ref):
+        return self._predict([src], [tgt], [ref])[0]
@@ -21,6 +21,8 @@ class PRISMMetric(BaseMetric):
         super().__init__()
 
         self.use_ref = use_ref
+        self.uses_src = not use_ref
+        self.lang2 = kwargs["lang2"]
 
         import sys
         import os
@@ -37,6 +39,10 @@ class PRISMMetric(BaseMetric):
         from prism import Prism
         self.model = Prism(model_dir="../prism/m39v1", lang=kwargs["lang2"])
 
+    def rebind(self, **kwargs):
+        # the model is loaded for a specific target language
+        return kwargs["lang2"] == self.lang2
+
     def _predict_single(self, src, tgt, ref):
         if self.use_ref:
             return self.model.score(cand=[tgt], ref=[ref], segment_scores=True)[0]
@@ -15,10 +15,13 @@
 
 from metrics_domain_adaptation import utils
 from .base import BaseMetric
+from . import cache
+from . import batching
+from . import encoder_cache
 
 
 class PRISMModel:
-    def __init__(self, lang1, lang2, device, model_name, model_type, nllb_finetuned=False):
+    def __init__(self, lang1, lang2, device, model_name, model_type, nllb_finetuned=False, encoder_cache_mb=1024):
         from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 
         self.device = device
@@ -29,8 +32,8 @@ class PRISMModel:
         self.max_src_len_tokens = 250
         self.max_tgt_len_tokens = 250
 
-        self.lang1 = lang1
-        self.lang2 = lang2
+        self.model_type = model_type
+        self.encoder_cache = encoder_cache.EncoderCache(max_bytes=encoder_cache_mb * 1024 * 1024)
 
         # lower precision to not get OOM
         if "3.3b" in model_name.lower():
@@ -39,177 +42,199 @@ class PRISMModel:
             self.model = self.model.to(self.device)
 
         if model_type == "opus":
-            self.score_w_src = self.score_w_src_opus
-            self.score_w_ref = self.score_w_ref_opus
             self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         elif model_type == "nllb":
-            self.score_w_src = self.score_w_src_nllb
-            self.score_w_ref = self.score_w_ref_nllb
-
             self.tokenizer = AutoTokenizer.from_pretrained(
                 model_name, src_lang=utils.LANG_TO_NLLB[lang1], tgt_lang=utils.LANG_TO_NLLB[lang2]
             )
             self.bos_id = self.tokenizer.convert_tokens_to_ids('</s>')
-            self.lang1nllb_id = self.tokenizer.convert_tokens_to_ids(
-                utils.LANG_TO_NLLB[lang1]
-            )
-            self.lang2nllb_id = self.tokenizer.convert_tokens_to_ids(
-                utils.LANG_TO_NLLB[lang2]
-            )
         elif model_type == "m100":
-            self.score_w_src = self.score_w_src_m100
-            self.score_w_ref = self.score_w_ref_m100
             self.tokenizer = AutoTokenizer.from_pretrained(
                 model_name, tgt_lang=lang2
             )
         else:
             raise Exception("Unknown model type")
 
-    def _score_1way_nllb(self, input_text, output_text, input_lang_id, input_lang):
-        # need to import locally
-        import torch
-        import numpy as np
+        self.lang1 = None
+        self.lang2 = None
+        self.rebind(lang1, lang2)
 
-        # this shouldn't have an effect because we are not using tokenizer's special tokens but just for consistency
-        self.tokenizer.src_lang = utils.LANG_TO_NLLB[input_lang]
+    def rebind(self, lang1, lang2):
+        """
+        Switch the language pair without reloading the model.
+        Returns False if the model itself is language-specific (opus).
+        """
+        if self.model_type == "opus" and self.lang1 is not None:
+            # opus models are trained for a single language pair
+            return (self.lang1, self.lang2) == (lang1, lang2)
 
-        src_ids_list = [
-            [input_lang_id, ] +
-            self.tokenizer.encode(input_text, add_special_tokens=False)[:self.max_src_len_tokens] +
-            [self.bos_id, ]
-        ]
-        src_ids = torch.tensor(src_ids_list, dtype=torch.int64)
-        tgt_ids_list = [
-            [self.bos_id, self.lang2nllb_id] +
-            self.tokenizer.encode(output_text, add_special_tokens=False)[:self.max_tgt_len_tokens] +
-            [self.bos_id, ]
-        ]
-        tgt_ids = torch.tensor(tgt_ids_list, dtype=torch.int64)
-        logits = self.model.forward(
-            input_ids=src_ids.to(self.device),
-            decoder_input_ids=tgt_ids.to(self.device)
-        )['logits']
-        log_probs = torch.nn.functional.log_softmax(logits, dim=-1)
-        log_probs2 = log_probs.squeeze().cpu().detach().numpy()
-
-        # best for finetuned
-        if self.nllb_finetuned:
-            log_probs2 = log_probs2[0:-1, :]
-            # lose nothing
-            idxs = tgt_ids.flatten().detach().numpy()[1:]
+        self.lang1 = lang1
+        self.lang2 = lang2
+        if self.model_type == "nllb":
+            self.tokenizer.src_lang = utils.LANG_TO_NLLB[lang1]
+            self.tokenizer.tgt_lang = utils.LANG_TO_NLLB[lang2]
+            self.lang1nllb_id = self.tokenizer.convert_tokens_to_ids(
+                utils.LANG_TO_NLLB[lang1]
+            )
+            self.lang2nllb_id = self.tokenizer.convert_tokens_to_ids(
+                utils.LANG_TO_NLLB[lang2]
+            )
+        elif self.model_type == "m100":
+            self.tokenizer.tgt_lang = lang2
+        return True
+
+    def _get_ids(self, input_text, output_text, input_lang):
+        """
+        Returns source and target token ids of a single sentence pair.
+        """
+        if self.model_type == "nllb":
+            input_lang_id = self.lang1nllb_id if input_lang == self.lang1 else self.lang2nllb_id
+            # this shouldn't have an effect because we are not using tokenizer's special tokens but just for consistency
+            self.tokenizer.src_lang = utils.LANG_TO_NLLB[input_lang]
+
+            src_ids = (
+                [input_lang_id, ] +
+                self.tokenizer.encode(input_text, add_special_tokens=False)[:self.max_src_len_tokens] +
+                [self.bos_id, ]
+            )
+            tgt_ids = (
+                [self.bos_id, self.lang2nllb_id] +
+                self.tokenizer.encode(output_text, add_special_tokens=False)[:self.max_tgt_len_tokens] +
+                [self.bos_id, ]
+            )
+        else:
+            src_ids = self.tokenizer.encode(
+                input_text, add_special_tokens=True
+            )[:self.max_src_len_tokens]
+            tgt_ids = self.tokenizer.encode(
+                output_text, add_special_tokens=True
+            )[:self.max_tgt_len_tokens]
+        return src_ids, tgt_ids
+
+    def _get_scored_positions(self):
+        """
+        Returns (shift, start) such that the log-prob at decoder position i is taken for target token i+shift
+        and the positions [start, len-shift) are averaged.
+        """
+        if self.model_type != "nllb":
+            # opus and m100 score each position with the token itself (no shift)
+            return 0, 0
+        elif self.nllb_finetuned:
+            # best for finetuned, lose nothing
+            return 1, 0
         else:
             # lose the language code prediction and the garbage prediction at the end
-            log_probs2 = log_probs2[1:-1, :]
             # lose </s> and language code (keep eos)
-            idxs = tgt_ids.flatten().detach().numpy()[2:]
-        scores = [log_probs2[ii, jj] for ii, jj in enumerate(idxs)]
-        avg_score = np.mean(scores)
-
-        return avg_score
-
-    def _score_1way_opus(self, input_text, output_text):
-        # need to import locally
+            return 1, 1
+
+    @staticmethod
+    def _target_log_probs(logits, targets):
+        """
+        Log-probabilities of the target tokens, one float per position.
+        Equivalent to gathering from log_softmax but without materializing it over the whole vocabulary.
+        """
         import torch
-        import numpy as np
 
-        tgt_ids_list = [
-            self.tokenizer.encode(
-                output_text, add_special_tokens=True
-            )[:self.max_tgt_len_tokens]
-        ]
-        tgt_ids = torch.tensor(tgt_ids_list, dtype=torch.int64)
-        src_ids_list = [
-            self.tokenizer.encode(
-                input_text, add_special_tokens=True
-            )[:self.max_src_len_tokens]
-        ]
-        src_ids = torch.tensor(src_ids_list, dtype=torch.int64)
-        logits = self.model.forward(
-            input_ids=src_ids.to(self.device),
-            decoder_input_ids=tgt_ids.to(self.device)
-        )['logits']
-        log_probs = torch.nn.functional.log_softmax(logits, dim=-1)
-        # [0] instead of squeeze to avoid undesired dimension collapse
-        log_probs2 = log_probs[0].cpu().detach().numpy()
-        idxs = tgt_ids.flatten().detach().numpy()
-        scores = [log_probs2[ii, jj] for ii, jj in enumerate(idxs)]
-
-        avg_score = np.mean(scores)
-
-        return avg_score
-
-    def _score_1way_m100(self, input_text, output_text):
+        return (
+            logits.gather(-1, targets.unsqueeze(-1)).squeeze(-1).float() -
+            torch.logsumexp(logits, dim=-1).float()
+        )
+
+    def _score_1way_batch(self, input_texts, output_texts, input_lang, batch_size, max_tokens=None):
+        """
+        Average log-probability of each output sentence given the input sentence.
+        The sentences are sorted by length and padded into batches of at most `max_tokens` tokens
+        and the padding is masked out of the average.
+        """
         # need to import locally
         import torch
-        import numpy as np
+        import tqdm
+        from transformers.modeling_outputs import BaseModelOutput
 
-        tgt_ids_list = [
-            self.tokenizer.encode(
-                output_text, add_special_tokens=True
-            )[:self.max_tgt_len_tokens]
+        shift, start = self._get_scored_positions()
+        ids = [
+            self._get_ids(input_text, output_text, input_lang)
+            for input_text, output_text in zip(input_texts, output_texts)
         ]
-        tgt_ids = torch.tensor(tgt_ids_list, dtype=torch.int64)
-        src_ids_list = [
-            self.tokenizer.encode(
-                input_text, add_special_tokens=True
-            )[:self.max_src_len_tokens]
-        ]
-        src_ids = torch.tensor(src_ids_list, dtype=torch.int64)
-        logits = self.model.forward(
-            input_ids=src_ids.to(self.device),
-            decoder_input_ids=tgt_ids.to(self.device)
-        )['logits']
-        log_probs = torch.nn.functional.log_softmax(logits, dim=-1)
-        # [0] instead of squeeze to avoid undesired dimension collapse
-        log_probs2 = log_probs[0].cpu().detach().numpy()
-        idxs = tgt_ids.flatten().detach().numpy()
-        scores = [log_probs2[ii, jj] for ii, jj in enumerate(idxs)]
-
-        avg_score = np.mean(scores)
-
-        return avg_score
-
-    def score_w_src_nllb(self, src_sent, tgt_sent):
-        return self._score_1way_nllb(
-            input_text=src_sent, output_text=tgt_sent,
-            input_lang_id=self.lang1nllb_id,
-            input_lang=self.lang1,
+        batches = batching.length_batches(
+            [len(src_ids) + len(tgt_ids) for src_ids, tgt_ids in ids],
+            max_tokens=max_tokens if max_tokens is not None else float("inf"),
+            max_batch_size=batch_size,
         )
-
-    def score_w_ref_nllb(self, ref_sent, tgt_sent):
-        fwd = self._score_1way_nllb(
-            input_text=ref_sent, output_text=tgt_sent,
-            input_lang_id=self.lang2nllb_id,
-            input_lang=self.lang2,
+        batch_scores = []
+        for batch in tqdm.tqdm(batches, disable=len(batches) <= 1):
+            src_ids_list, tgt_ids_list = zip(*[ids[i] for i in batch])
+            src_ids, src_mask = encoder_cache.pad(src_ids_list, self.tokenizer.pad_token_id)
+            tgt_ids, _tgt_mask = encoder_cache.pad(tgt_ids_list, self.tokenizer.pad_token_id)
+            tgt_lens = torch.tensor([len(x) for x in tgt_ids_list], dtype=torch.int64)
+
+            with torch.no_grad():
+                encoder_states = self.encoder_cache.encode(
+                    self.model.get_encoder(), src_ids_list,
+                    keys=[(input_texts[i], input_lang) for i in batch],
+                    pad_token_id=self.tokenizer.pad_token_id, device=self.device,
+                )
+                # right padding of the decoder input does not affect the previous positions
+                logits = self.model.forward(
+                    encoder_outputs=BaseModelOutput(last_hidden_state=torch.nn.utils.rnn.pad_sequence(
+                        encoder_states, batch_first=True
+                    )),
+                    attention_mask=src_mask.to(self.device),
+                    decoder_input_ids=tgt_ids.to(self.device)
+                )['logits']
+                # log-prob of position i is taken for the target token i+shift
+                target_len = tgt_ids.shape[1]-shift
+                log_probs = self._target_log_probs(
+                    logits[:, :target_len, :], tgt_ids[:, shift:].to(self.device)
+                ).cpu()
+                positions = torch.arange(target_len).unsqueeze(0)
+                mask = (positions >= start) & (positions < (tgt_lens-shift).unsqueeze(1))
+                log_probs = log_probs.masked_fill(~mask, 0.0)
+                batch_scores.append((log_probs.sum(dim=1) / mask.sum(dim=1)).tolist())
+
+        return batching.unsort(batches, batch_scores)
+
+    def score_w_src(self, src_sent, tgt_sent):
+        return self.score_w_src_batch([src_sent], [tgt_sent])[0]
+
+    def score_w_ref(self, ref_sent, tgt_sent):
+        return self.score_w_ref_batch([ref_sent], [tgt_sent])[0]
+
+    def score_w_src_batch(self, src_sents, tgt_sents, batch_size=1, max_tokens=None):
+        return self._score_1way_batch(
+            input_texts=src_sents, output_texts=tgt_sents,
+            input_lang=self.lang1, batch_size=batch_size, max_tokens=max_tokens,
         )
-        rev = self._score_1way_nllb(
-            input_text=tgt_sent, output_text=ref_sent,
-            input_lang_id=self.lang2nllb_id,
-            input_lang=self.lang2,
-        )
-        return (fwd + rev)/2.0
-
-    def score_w_src_m100(self, src_sent, tgt_sent):
-        return self._score_1way_m100(src_sent, tgt_sent)
 
-    def score_w_ref_m100(self, ref_sent, tgt_sent):
-        fwd = self._score_1way_m100(ref_sent, tgt_sent)
-        rev = self._score_1way_m100(tgt_sent, ref_sent)
-        return (fwd + rev)/2.0
+    def score_w_ref_batch(self, ref_sents, tgt_sents, batch_size=1, max_tokens=None):
+        if self.model_type == "opus":
+            raise Exception("Not implemented")
 
-    def score_w_src_opus(self, src_sent, tgt_sent):
-        return self._score_1way_opus(src_sent, tgt_sent)
-
-    def score_w_ref_opus(self, ref_sent, tgt_sent):
-        raise Exception("Not implemented")
+        fwd = self._score_1way_batch(
+            input_texts=ref_sents, output_texts=tgt_sents,
+            input_lang=self.lang2, batch_size=batch_size, max_tokens=max_tokens,
+        )
+        rev = self._score_1way_batch(
+            input_texts=tgt_sents, output_texts=ref_sents,
+            input_lang=self.lang2, batch_size=batch_size, max_tokens=max_tokens,
+        )
+        return [(x_fwd + x_rev)/2.0 for x_fwd, x_rev in zip(fwd, rev)]
 
 
 class PRISM2Metric(BaseMetric):
     # lang codes from here https://github.com/facebookresearch/flores/blob/main/flores200/README.md#languages-in-flores-200
 
-    def __init__(self, lang1, lang2, prism_mode, model_name='facebook/nllb-200-distilled-600M', **kwargs):
+    def __init__(
+        self, lang1, lang2, prism_mode, model_name='facebook/nllb-200-distilled-600M',
+        batch_size=16, max_tokens=4096, encoder_cache_mb=1024, **kwargs
+    ):
         super().__init__()
 
+        # may come as a string from the command line
+        self.batch_size = int(batch_size)
+        # padded source+target tokens per batch
+        self.max_tokens = int(max_tokens)
+
         # need to do imports locally
         import torch
 
@@ -221,6 +246,7 @@ class PRISM2Metric(BaseMetric):
 
         assert prism_mode in {"src", "ref", "mix"}
         self.prism_mode = prism_mode
+        self.uses_src = prism_mode != "ref"
 
         if "opus" in model_name.lower():
             model_type = "opus"
@@ -234,6 +260,7 @@ class PRISM2Metric(BaseMetric):
             )
 
         print(f"Using {model_type} as model type.")
+        self.model_name = model_name
 
         self.prism = PRISMModel(
             lang1=lang1, lang2=lang2,
@@ -241,8 +268,36 @@ class PRISM2Metric(BaseMetric):
             model_name=model_name,
             model_type=model_type,
             nllb_finetuned=not model_name.startswith("facebook/"),
+            # sources and references are encoded once and not for every system output
+            encoder_cache_mb=int(encoder_cache_mb),
         )
 
+    def fingerprint(self):
+        return cache.fingerprint_path(self.model_name)
+
+    def rebind(self, **kwargs):
+        return self.prism.rebind(lang1=kwargs["lang1"], lang2=kwargs["lang2"])
+
+    def reconfigure(self, **kwargs):
+        if "encoder_cache_mb" in kwargs:
+            self.prism.encoder_cache.resize(int(kwargs["encoder_cache_mb"]) * 1024 * 1024)
+
+    def _predict(self, src, tgt, ref):
+        batch_kwargs = {"batch_size": self.batch_size, "max_tokens": self.max_tokens}
+        if self.prism_mode == "ref":
+            return self.prism.score_w_ref_batch(ref_sents=ref, tgt_sents=tgt, **batch_kwargs)
+        elif self.prism_mode == "src":
+            return self.prism.score_w_src_batch(src_sents=src, tgt_sents=tgt, **batch_kwargs)
+        elif self.prism_mode == "mix":
+            return [
+                x_src + x_ref for x_src, x_ref in zip(
+                    self.prism.score_w_src_batch(src_sents=src, tgt_sents=tgt, **batch_kwargs),
+                    self.prism.score_w_ref_batch(ref_sents=ref, tgt_sents=tgt, **batch_kwargs),
+                )
+            ]
+        else:
+            return [None]*len(tgt)
+
     def _predict_single(self, src, tgt, ref):
         if self.prism_mode == "ref":
             return self.prism.score_w_ref(ref_sent=ref, tgt_sent=tgt)
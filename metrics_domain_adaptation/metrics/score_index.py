@@ -0,0 +1,101 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+#
+# Compact index of precomputed segment scores (GEMBA, BLEMBA outputs).
+# The JSONL files are compiled into a sorted table of 64-bit triplet hashes and float32 scores
+# stored in $ADAPTATION_ROOT/cache/score_index/, which is memory-mapped and searched with binary search.
+# The index is rebuilt whenever the JSONL file is newer (see also scripts/04-misc/09-build_score_index.py).
+#
+
+import os
+import json
+import hashlib
+import numpy as np
+from typing import List
+from . import cache
+
+_DTYPE = np.dtype([("hash", "<u8"), ("score", "<f4")])
+
+
+def hash_triplet_64(src, tgt, ref) -> int:
+    return int(cache.hash_triplet(src, tgt, ref)[:16], 16)
+
+
+def index_path(fname) -> str:
+    from metrics_domain_adaptation import utils
+    key = hashlib.sha256(os.path.abspath(fname).encode("utf-8")).hexdigest()
+    return f"{utils.ROOT}/cache/score_index/{key}.npy"
+
+
+def build(fname, score_key, path=None) -> str:
+    """
+    Compiles the JSONL file into the index and returns its path.
+    Lines without a score are skipped and for duplicates the first score is kept.
+    """
+    if path is None:
+        path = index_path(fname)
+
+    scores = {}
+    with open(fname, "r") as f:
+        for line in f:
+            line = json.loads(line)
+            if line.get(score_key) is None:
+                continue
+            scores.setdefault(hash_triplet_64(line["src"], line["tgt"], line["ref"]), line[score_key])
+
+    table = np.array(list(scores.items()), dtype=_DTYPE)
+    table.sort(order="hash")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so that a concurrent run never loads a partial index
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, table)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+class ScoreIndex():
+    def __init__(self, fname, score_key):
+        path = index_path(fname)
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(fname):
+            print(f"Building score index for {fname}")
+            build(fname, score_key, path)
+        self.table = np.load(path, mmap_mode="r")
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def lookup(self, src, tgt, ref) -> List:
+        """
+        Scores of the triplets, None for the ones which are not in the index.
+        """
+        hashes = np.array([
+            hash_triplet_64(src_line, tgt_line, ref_line)
+            for src_line, tgt_line, ref_line in zip(src, tgt, ref)
+        ], dtype="<u8")
+        positions = np.searchsorted(self.table["hash"], hashes)
+        positions = np.minimum(positions, max(0, len(self.table)-1))
+        found = (
+            (self.table["hash"][positions] == hashes)
+            if len(self.table) else np.zeros(len(hashes), dtype=bool)
+        )
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        scores = self.table["score"][positions] if len(self.table) else np.zeros(len(hashes))
+        return [
+            float(score) if is_found else None
+            for score, is_found in zip(scores, found)
+        ]
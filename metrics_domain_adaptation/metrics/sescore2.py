@@ -14,13 +14,22 @@
 #  limitations under the License.
 
 from .base import BaseMetric
+from . import batching
 
 
 class SEScore2Metric(BaseMetric):
-    def __init__(self, use_ref, **kwargs):
+    uses_src = False
+
+    def __init__(self, use_ref, batch_size=16, check_parity=8, **kwargs):
         super().__init__()
 
+        # may come as strings from the command line
+        self.batch_size = int(batch_size)
+        # number of segments (a fixed sample) which are also scored one by one to compare with the batched scores,
+        # 0 turns the check off
+        self.check_parity = int(check_parity)
         self.use_ref = use_ref
+        self.lang2 = kwargs["lang2"]
 
         import sys
         # make sure that prism is installed there
@@ -32,10 +41,51 @@ class SEScore2Metric(BaseMetric):
 
         self.model = SEScore2(kwargs["lang2"])
 
+    def rebind(self, **kwargs):
+        # the model is loaded for a specific target language
+        return kwargs["lang2"] == self.lang2
+
     def _predict_single(self, src, tgt, ref):
         output = self.model.score([ref], [tgt], 1)[0]
         return output
 
-    # def _predict(self, src, tgt, ref):
-    #     output = self.model.score(ref, tgt, 1)
-    #     return output
+    def _score_batch(self, tgt, ref):
+        """
+        Scores a batch and if it fails, splits it in halves so that only the failing segments are scored one by one.
+        """
+        if len(tgt) == 1:
+            return [self._predict_single(None, tgt[0], ref[0])]
+        try:
+            return list(self.model.score(ref, tgt, len(tgt)))
+        except Exception as e:
+            print(f"SEScore2 batch of {len(tgt)} failed ({e}), splitting")
+            half = len(tgt) // 2
+            return self._score_batch(tgt[:half], ref[:half]) + self._score_batch(tgt[half:], ref[half:])
+
+    def _predict(self, src, tgt, ref):
+        import tqdm
+
+        # sort by length to reduce padding
+        batches = batching.length_batches(
+            [len(tgt_line.split()) + len(ref_line.split()) for tgt_line, ref_line in zip(tgt, ref)],
+            max_tokens=float("inf"), max_batch_size=self.batch_size,
+        )
+        scores = batching.unsort(batches, [
+            self._score_batch([tgt[i] for i in batch], [ref[i] for i in batch])
+            for batch in tqdm.tqdm(batches)
+        ])
+
+        if self.check_parity and tgt:
+            import random
+            sample = random.Random(0).sample(range(len(tgt)), k=min(len(tgt), self.check_parity))
+            diff = max(
+                abs(scores[i] - self._predict_single(None, tgt[i], ref[i]))
+                for i in sample
+            )
+            print(f"SEScore2 parity: max difference between batched and single scores {diff:.2e}")
+            if diff > 1e-4:
+                raise Exception(
+                    f"Batched SEScore2 scores differ from the single ones by up to {diff:.2e}, "
+                    "use batch_size=1 to score the segments one by one"
+                )
+        return scores
@@ -14,13 +14,167 @@
 #  limitations under the License.
 
 from .base import BaseMetric
+from collections import Counter
+
+#
+# Built-in sentence-level engines which compute the statistics for the whole list at once
+# instead of calling `evaluate` (arrow tables, feature validation) for every segment.
+# They reproduce the defaults of the corresponding `evaluate` metrics
+# (google_bleu via NLTK, chrf and ter via sacrebleu, character via cer, nist_mt via NLTK).
+#
+# Many rows share the same reference (different systems translating the same source)
+# so the n-gram statistics of the references are computed only once and stored in `ref_index`,
+# which is keyed by the reference text and kept by the metric for the whole run.
+#
+
+
+def _word_ngrams(tokens, max_n):
+    """
+    Counts of all word n-grams of orders 1..max_n in a single Counter.
+    """
+    return Counter(
+        tuple(tokens[i:i+n])
+        for n in range(1, max_n+1)
+        for i in range(len(tokens)-n+1)
+    )
+
+
+def _char_ngrams(line, max_n):
+    """
+    Counts of character n-grams (whitespace removed) for each order 1..max_n.
+    """
+    line = "".join(line.split())
+    return [
+        Counter(line[i:i+n] for i in range(len(line)-n+1))
+        for n in range(1, max_n+1)
+    ]
+
+
+def _count_matches(hyp_ngrams, ref_ngrams):
+    return sum(
+        min(count, ref_ngrams[ngram])
+        for ngram, count in hyp_ngrams.items()
+        if ngram in ref_ngrams
+    )
+
+
+def _native_google_bleu(tgt, ref, ref_index):
+    from sacrebleu.tokenizers.tokenizer_13a import Tokenizer13a
+    tokenizer = Tokenizer13a()
+
+    scores = []
+    for tgt_line, ref_line in zip(tgt, ref):
+        if ref_line not in ref_index:
+            ref_ngrams = _word_ngrams(tokenizer(ref_line).split(), max_n=4)
+            ref_index[ref_line] = (ref_ngrams, sum(ref_ngrams.values()))
+        ref_ngrams, n_ref = ref_index[ref_line]
+
+        hyp_ngrams = _word_ngrams(tokenizer(tgt_line).split(), max_n=4)
+        n_all = max(sum(hyp_ngrams.values()), n_ref)
+        n_match = _count_matches(hyp_ngrams, ref_ngrams)
+        scores.append(n_match / n_all if n_all > 0 else 0.0)
+    return scores
+
+
+def _native_chrf(tgt, ref, ref_index, char_order=6, beta=2):
+    factor = beta ** 2
+
+    scores = []
+    for tgt_line, ref_line in zip(tgt, ref):
+        if ref_line not in ref_index:
+            ref_index[ref_line] = [
+                (ref_ngrams, sum(ref_ngrams.values()))
+                for ref_ngrams in _char_ngrams(ref_line, char_order)
+            ]
+
+        # effective order smoothing (sacrebleu default)
+        avg_prec, avg_rec, effective_order = 0.0, 0.0, 0
+        for hyp_ngrams, (ref_ngrams, n_ref) in zip(_char_ngrams(tgt_line, char_order), ref_index[ref_line]):
+            n_hyp = sum(hyp_ngrams.values())
+            if n_hyp > 0 and n_ref > 0:
+                n_match = _count_matches(hyp_ngrams, ref_ngrams)
+                avg_prec += n_match / n_hyp
+                avg_rec += n_match / n_ref
+                effective_order += 1
+
+        if effective_order > 0:
+            avg_prec /= effective_order
+            avg_rec /= effective_order
+        if avg_prec + avg_rec > 0:
+            scores.append(100 * (1 + factor) * avg_prec * avg_rec / (factor * avg_prec + avg_rec))
+        else:
+            scores.append(0.0)
+    return scores
+
+
+def _native_ter(tgt, ref, ref_index):
+    # the shifting edit distance is the expensive part, reuse sacrebleu's implementation
+    from sacrebleu.metrics import TER
+    ter = TER()
+    return [
+        ter.sentence_score(tgt_line, [ref_line]).score
+        for tgt_line, ref_line in zip(tgt, ref)
+    ]
+
+
+def _native_character(tgt, ref, ref_index):
+    from cer import calculate_cer
+    return [
+        calculate_cer(tgt_line.split(), ref_line.split())
+        for tgt_line, ref_line in zip(tgt, ref)
+    ]
+
+
+def _native_nist_mt(tgt, ref, ref_index, max_n=5):
+    import math
+    from nltk.tokenize.nist import NISTTokenizer
+    from nltk.translate.nist_score import nist_length_penalty
+    tokenizer = NISTTokenizer()
+
+    scores = []
+    for tgt_line, ref_line in zip(tgt, ref):
+        if ref_line not in ref_index:
+            ref_tokens = tokenizer.tokenize(ref_line, return_str=False, lowercase=False, western_lang=True)
+            ref_ngrams = _word_ngrams(ref_tokens, max_n=max_n)
+            # information weights are estimated from the single reference
+            ref_index[ref_line] = (ref_ngrams, len(ref_tokens), {
+                ngram: math.log(
+                    (ref_ngrams[ngram[:-1]] if len(ngram) > 1 else len(ref_tokens)) / count, 2
+                )
+                for ngram, count in ref_ngrams.items()
+            })
+        ref_ngrams, ref_len, info_weights = ref_index[ref_line]
+
+        hyp_tokens = tokenizer.tokenize(tgt_line, return_str=False, lowercase=False, western_lang=True)
+        numerators = Counter()
+        for ngram, count in _word_ngrams(hyp_tokens, max_n=max_n).items():
+            if ngram in ref_ngrams:
+                numerators[len(ngram)] += min(count, ref_ngrams[ngram]) * info_weights[ngram]
+
+        precision = sum(
+            numerators[n] / (len(hyp_tokens)-n+1)
+            # NLTK raises ZeroDivisionError for hypotheses shorter than max_n, we count it as 0
+            for n in range(1, max_n+1) if len(hyp_tokens) >= n
+        )
+        scores.append(precision * nist_length_penalty(ref_len, len(hyp_tokens)))
+    return scores
+
+
+_NATIVE = {
+    "google_bleu": _native_google_bleu,
+    "chrf": _native_chrf,
+    "ter": _native_ter,
+    "character": _native_character,
+    "nist_mt": _native_nist_mt,
+}
 
 
 class StringMatching(BaseMetric):
+    uses_src = False
+
     def __init__(self, **kwargs):
         super().__init__()
-        import evaluate
-        self.metric = evaluate.load(kwargs["name"])
+        self.name = kwargs["name"]
         if "predict_kwargs" in kwargs:
             self.predict_kwargs = kwargs["predict_kwargs"]
         else:
@@ -30,7 +184,37 @@ class StringMatching(BaseMetric):
         else:
             self.retrieve_key = "score"
 
+        # use the built-in engine unless asked for `--engine evaluate` or non-default arguments
+        self.native = (
+            kwargs.get("engine", "native") == "native" and
+            self.name in _NATIVE and not self.predict_kwargs
+        )
+        if not self.native:
+            import evaluate
+            self.metric = evaluate.load(self.name)
+        # reference n-gram statistics shared by all rows with the same reference
+        self.ref_index = {}
+
+    def _predict(self, src, tgt, ref):
+        if self.native:
+            return _NATIVE[self.name](tgt, ref, ref_index=self.ref_index)
+        else:
+            return super()._predict(src, tgt, ref)
+
+    def fingerprint(self):
+        # the built-in engine is covered by the code hash, `evaluate` scores may change with the library
+        if self.native:
+            return "native"
+        import evaluate
+        return f"evaluate-{evaluate.__version__}"
+
+    def shardable(self):
+        # the built-in engine is batched, the `evaluate` one scores every segment separately
+        return not self.native
+
     def _predict_single(self, src, tgt, ref):
+        if self.native:
+            return _NATIVE[self.name]([tgt], [ref], ref_index=self.ref_index)[0]
         output = self.metric.compute(
             predictions=[tgt], references=[[ref]],
             **self.predict_kwargs
@@ -40,7 +224,7 @@ class StringMatching(BaseMetric):
 
 class StringMatchingSingle(StringMatching):
     def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+        super().__init__(**(kwargs | {"engine": "evaluate"}))
 
     def _predict_single(self, src, tgt, ref):
         try:
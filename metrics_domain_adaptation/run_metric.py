@@ -28,78 +28,158 @@ import metrics
 from scipy.stats import kendalltau
 import json
 import time
+import sys
+import traceback
 
-args = argparse.ArgumentParser()
-args.add_argument("--langs", default="all")
-args.add_argument("--metric", default="comet-da")
-args.add_argument("--domain", default="all")
-args.add_argument("--split", default="test")
-args.add_argument("--save-scores-path", default=None)
-args.add_argument("--count", type=int, default=None)
-args, args_unknown = args.parse_known_args()
-
-args_unknown = dict(zip(args_unknown[:-1:2], args_unknown[1::2]))
-args_unknown = {
-    k.lstrip("-").replace("-", "_"): v
-    for k, v in args_unknown.items()
-}
-
-if args.langs == "all":
-    langs = ["en-de", "en-ru", "zh-en"]
-elif args.langs == "total":
-    langs = utils.LANGS
-else:
-    langs = [args.langs]
-
-if args.domain == "all":
-    domains = ["bio", "general"]
-else:
-    domains = [args.domain]
-
-line_for_export = []
-for domain in domains:
-    taus = []
-    for lang in langs:
-        data = utils.load_data(
-            kind="mqm", domain=domain,
-            langs=lang, split=args.split
-        )
-
-        if args.count:
-            data = random.Random(0).sample(data, k=min(len(data), args.count))
-        print(lang, domain, len(data))
-        lang1, lang2 = lang.split("-")
-        metric = metrics.get(
-            args.metric,
-            lang1=lang1, lang2=lang2, domain=domain,
-            **args_unknown,
-        )
-        scores_true = [x["score"] for x in data]
-        scores = metric.predict(*utils.transpose_keys(data))
-
-        if args.save_scores_path:
-            for line, score_new in zip(data, scores):
-                line_new = {
-                    "langs": lang, "metric": args.metric,
-                    "domain": domain,
-                    "args": args_unknown,
-                    "model_score": score_new,
-                } | line
-                line_for_export.append(line_new)
-
-        tau, _tau_p = kendalltau(scores_true, scores)
-        print("JSON!" + json.dumps({
-            "langs": lang, "metric": args.metric,
-            "domain": domain, "tau": tau,
-            "time": time.ctime(),
-            "args": args_unknown,
-        }))
-        taus.append(tau)
-
-    print(f"Average Tau for {domain}: {np.average(np.abs(taus)):.3f}")
-
-
-if args.save_scores_path:
-    with open(args.save_scores_path, "w") as f:
-        for line in line_for_export:
-            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument("--langs", default="all")
+    args.add_argument(
+        "--metric", default="comet-da",
+        help="Single metric or a comma-separated list of metrics which are all run on the same loaded data."
+    )
+    args.add_argument(
+        "--metric-set", default=None,
+        help="Named list of metrics from metrics.METRIC_SETS (e.g. base), overrides --metric."
+    )
+    args.add_argument("--domain", default="all")
+    args.add_argument("--split", default="test")
+    args.add_argument("--save-scores-path", default=None)
+    args.add_argument(
+        "--output", default=None,
+        help="Append the JSON! lines also to this file as soon as they are computed."
+    )
+    args.add_argument("--count", type=int, default=None)
+    args.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of worker processes among which the segments are sharded (only for metrics which score segments one by one, e.g. --engine evaluate)."
+    )
+    args.add_argument(
+        "--score-cache", action="store_true",
+        help="Reuse segment scores stored in $ADAPTATION_ROOT/cache/scores/ and store the new ones there."
+    )
+    args, args_unknown = args.parse_known_args()
+
+    args_unknown = dict(zip(args_unknown[:-1:2], args_unknown[1::2]))
+    args_unknown = {
+        k.lstrip("-").replace("-", "_"): v
+        for k, v in args_unknown.items()
+    }
+
+    if args.score_cache:
+        metrics.cache.enable()
+
+    if args.metric_set is not None:
+        metric_names = metrics.METRIC_SETS[args.metric_set]
+    else:
+        metric_names = args.metric.split(",")
+
+    if args.langs == "all":
+        langs = ["en-de", "en-ru", "zh-en"]
+    elif args.langs == "total":
+        langs = utils.LANGS
+    else:
+        langs = [args.langs]
+
+    if args.domain == "all":
+        domains = ["bio", "general"]
+    else:
+        domains = [args.domain]
+
+    # load every split only once and share it between all the metrics
+    splits = {}
+    for domain in domains:
+        for lang in langs:
+            data = utils.load_data(
+                kind="mqm", domain=domain,
+                langs=lang, split=args.split
+            )
+
+            if args.count:
+                data = random.Random(0).sample(data, k=min(len(data), args.count))
+            splits[(domain, lang)] = (data, utils.transpose_keys(data))
+
+    output_file = open(args.output, "a") if args.output else None
+
+    line_for_export = []
+    failed = []
+    for metric_name in metric_names:
+        # a failing metric (e.g. missing model) does not stop the rest of the sweep
+        try:
+            for domain in domains:
+                taus = []
+                for lang in langs:
+                    data, data_transposed = splits[(domain, lang)]
+                    print(metric_name, lang, domain, len(data))
+                    lang1, lang2 = lang.split("-")
+                    metric = metrics.get_pooled(
+                        metric_name,
+                        lang1=lang1, lang2=lang2, domain=domain,
+                        **args_unknown,
+                    )
+                    metric.workers = args.workers
+                    scores_true = [x["score"] for x in data]
+                    if getattr(metric, "layers", None):
+                        # all layers from a single forward pass, one line per layer
+                        scores_all = {
+                            layer: scores_layer[2]
+                            for layer, scores_layer in metric.predict_layers(*data_transposed).items()
+                        }
+                    else:
+                        scores_all = {None: metric.predict(*data_transposed)}
+
+                    for layer, scores in scores_all.items():
+                        args_line = args_unknown
+                        if layer is not None:
+                            args_line = {k: v for k, v in args_unknown.items() if k != "layers"} | {"num_layers": layer}
+
+                        if args.save_scores_path:
+                            for line, score_new in zip(data, scores):
+                                line_new = {
+                                    "langs": lang, "metric": metric_name,
+                                    "domain": domain,
+                                    "args": args_line,
+                                    "model_score": score_new,
+                                } | line
+                                line_for_export.append(line_new)
+
+                        tau, _tau_p = kendalltau(scores_true, scores)
+                        line_out = json.dumps({
+                            "langs": lang, "metric": metric_name,
+                            "domain": domain, "tau": tau,
+                            "time": time.ctime(),
+                            "args": args_line,
+                        })
+                        print("JSON!" + line_out)
+                        if output_file:
+                            output_file.write(line_out + "\n")
+                            output_file.flush()
+                    # with multiple layers, the average is over the last one
+                    taus.append(tau)
+
+                print(f"Average Tau for {metric_name} on {domain}: {np.average(np.abs(taus)):.3f}")
+        except Exception:
+            traceback.print_exc()
+            print(f"Metric {metric_name} failed, continuing with the next one")
+            failed.append(metric_name)
+
+        # free the model before loading the next metric
+        metrics.release(metric_name)
+
+    if output_file:
+        output_file.close()
+
+    if args.save_scores_path:
+        with open(args.save_scores_path, "w") as f:
+            for line in line_for_export:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    if failed:
+        print("Failed metrics:", ", ".join(failed))
+        sys.exit(1)
+
+
+# the worker processes (--workers) may be spawned and import this file
+if __name__ == "__main__":
+    main()
@@ -26,19 +26,11 @@ read
 
 rm -f $OUTFILE
 
-for DOMAIN in "general" "bio"; do
-for METRIC in "bleu" "chrf" "ter" "meteor" \
-    "comet" "comet-qe" "comet-da" "cometinho" "cometinho-da" \
-    "unite-mup" "bleurt" "bertscore-xlmr" "bartscore" \
-    "prism-ref" "prism-src"; do
-    echo "### Running $METRIC on $DOMAIN";
-    ./metrics_domain_adaptation/run_metric.py \
-        --metric $METRIC --domain $DOMAIN --langs all \
-        | grep JSON! \
-        | cut -c 6- \
-        >> $OUTFILE
-done;
-done;
+# all metrics run in a single process which loads the data only once
+# scores of already seen segments are taken from the score cache
+./metrics_domain_adaptation/run_metric.py \
+    --metric-set base --domain all --langs all \
+    --output $OUTFILE --score-cache
 
 # remove malformed prism-src and prism-ref bytes
 # sed 's/\x0//g' -i ${ADAPTATION_ROOT}/computed/metrics_base.jsonl
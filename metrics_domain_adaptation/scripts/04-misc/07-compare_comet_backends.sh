@@ -0,0 +1,32 @@
+
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#!/usr/bin/bash
+
+# 
+# Compare Kendall's tau of the int8 quantized COMET backend against fp32 on the bio test set.
+# 
+
+OUTFILE="computed/metrics_comet_backends.jsonl"
+
+rm -f $OUTFILE
+
+for BACKEND in "fp32" "int8"; do
+    ./metrics_domain_adaptation/run_metric.py \
+        --metric comet,comet-da,comet-qe --domain bio --langs all \
+        --device cpu --backend $BACKEND \
+        --output $OUTFILE
+done;
+
+./metrics_domain_adaptation/scripts/04-misc/08-backend_report.py $OUTFILE
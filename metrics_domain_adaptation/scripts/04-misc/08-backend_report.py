@@ -0,0 +1,57 @@
+
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#!/usr/bin/env python3
+
+#
+# Prints Kendall's tau of each metric and language pair for every backend (see 07-compare_comet_backends.sh)
+# together with the difference to fp32.
+#
+
+import json
+import collections
+import argparse
+
+args = argparse.ArgumentParser()
+args.add_argument("jsonl_file")
+args.add_argument("--reference", default="fp32")
+args = args.parse_args()
+
+data_raw = [
+    json.loads(x)
+    for x in open(args.jsonl_file, "r")
+]
+
+# (metric, domain, langs) -> backend -> tau
+taus = collections.defaultdict(dict)
+for line in data_raw:
+    backend = line["args"].get("backend", "fp32")
+    taus[(line["metric"], line["domain"], line["langs"])][backend] = line["tau"]
+
+backends = sorted({backend for taus_local in taus.values() for backend in taus_local} - {args.reference})
+print(
+    f"{'metric':<12} {'domain':<8} {'langs':<6} {args.reference:>7} " +
+    " ".join(f"{backend:>7} {'diff':>7}" for backend in backends)
+)
+for (metric, domain, langs), taus_local in sorted(taus.items()):
+    tau_ref = taus_local.get(args.reference)
+    print(
+        f"{metric:<12} {domain:<8} {langs:<6} " +
+        (f"{tau_ref:>7.3f} " if tau_ref is not None else f"{'-':>7} ") +
+        " ".join(
+            f"{taus_local[backend]:>7.3f} {taus_local[backend]-tau_ref:>+7.3f}"
+            if backend in taus_local and tau_ref is not None else f"{'-':>7} {'-':>7}"
+            for backend in backends
+        )
+    )
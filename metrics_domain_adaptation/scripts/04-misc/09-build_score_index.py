@@ -0,0 +1,40 @@
+
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#!/usr/bin/env python3
+
+#
+# Compiles precomputed GEMBA/BLEMBA scores into the index used by the metrics (see metrics/score_index.py).
+# The metrics build the index themselves when it is missing or stale, this only does it ahead of time, e.g.
+# ./scripts/04-misc/09-build_score_index.py $ADAPTATION_ROOT/data/computed/gemba/*/*/*.jsonl
+#
+
+import argparse
+from metrics_domain_adaptation.metrics import score_index
+
+args = argparse.ArgumentParser()
+args.add_argument("jsonl_files", nargs="+")
+args.add_argument(
+    "--score-key", default=None,
+    help="Defaults to gpt_score for GEMBA and blemba_score for BLEMBA outputs."
+)
+args = args.parse_args()
+
+for fname in args.jsonl_files:
+    score_key = args.score_key
+    if score_key is None:
+        score_key = "blemba_score" if "blemba" in fname else "gpt_score"
+    path = score_index.build(fname, score_key)
+    index = score_index.ScoreIndex(fname, score_key)
+    print(f"{fname}: {len(index)} triplets -> {path}")
@@ -23,10 +23,11 @@ BIO_COUNT=$1
 SEED=$2
 
 # run eval for both the first and the second epoch
-for f in ${ADAPTATION_ROOT}/models/trained/finetune_datasize/count${BIO_COUNT}_seed${SEED}/*.ckpt; do
-  echo "Running $f on gpu:${CUDA_VISIBLE_DEVICES}" 1>&2;
-  ./metrics_domain_adaptation/run_metric.py --metric comet-ours --model-path "$f" | grep JSON | cut -c 6- >> ${ADAPTATION_ROOT}/computed/metrics_finetune_datasize.jsonl;
-done
+# all checkpoints are evaluated in a single process which loads and tokenizes the data only once
+echo "Running on gpu:${CUDA_VISIBLE_DEVICES}" 1>&2;
+./metrics_domain_adaptation/evaluate_checkpoints.py \
+    "${ADAPTATION_ROOT}/models/trained/finetune_datasize/count${BIO_COUNT}_seed${SEED}/*.ckpt" \
+    --metric comet-ours --output ${ADAPTATION_ROOT}/computed/metrics_finetune_datasize.jsonl;
 
 # examples:
 # CUDA_VISIBLE_DEVICES=0 nohup ./metrics_domain_adaptation/scripts/05-adapt_mqm/05a-finetune_datasize_eval.sh "*" "5" &
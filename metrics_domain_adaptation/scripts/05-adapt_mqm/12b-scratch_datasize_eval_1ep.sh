@@ -24,10 +24,11 @@ BIO_UPSAMPLE=$2
 SEED=$3
 
 # run eval for both the first and the second epoch
-for f in ${ADAPTATION_ROOT}/models/trained/scratch_datasize_1ep/count${BIO_COUNT}_up${BIO_UPSAMPLE}_seed${SEED}/*.ckpt; do
-  echo "Running $f on gpu:${CUDA_VISIBLE_DEVICES}" 1>&2;
-  ./metrics_domain_adaptation/run_metric.py --metric comet-ours --model-path "$f" | grep JSON | cut -c 6- >> ${ADAPTATION_ROOT}/computed/metrics_scratch_datasize_1ep.jsonl;
-done
+# all checkpoints are evaluated in a single process which loads and tokenizes the data only once
+echo "Running on gpu:${CUDA_VISIBLE_DEVICES}" 1>&2;
+./metrics_domain_adaptation/evaluate_checkpoints.py \
+    "${ADAPTATION_ROOT}/models/trained/scratch_datasize_1ep/count${BIO_COUNT}_up${BIO_UPSAMPLE}_seed${SEED}/*.ckpt" \
+    --metric comet-ours --output ${ADAPTATION_ROOT}/computed/metrics_scratch_datasize_1ep.jsonl;
 
 
 # CUDA_VISIBLE_DEVICES=0 nohup ./metrics_domain_adaptation/scripts/05-adapt_mqm/12b-scratch_datasize_eval_1ep.sh "5500" "6" "0" &
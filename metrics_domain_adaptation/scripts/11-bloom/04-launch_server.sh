@@ -23,7 +23,7 @@ MODEL_CLASS=AutoModelForCausalLM \
 DEPLOYMENT_FRAMEWORK=hf_accelerate \
 DTYPE=int8 \
 MAX_INPUT_LENGTH=2048 \
-MAX_BATCH_SIZE=1 \
+MAX_BATCH_SIZE=${MAX_BATCH_SIZE:-8} \
 CUDA_VISIBLE_DEVICES=0,1,2,3,4,5,6,7 \
 nohup gunicorn -t 0 -w 1 -b 127.0.0.1:5000 inference_server.server:app --access-logfile - --access-logformat '%(h)s %(t)s "%(r)s" %(s)s %(b)s' > server.log &
 
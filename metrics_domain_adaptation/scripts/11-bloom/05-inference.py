@@ -15,13 +15,23 @@
 
 #!/usr/bin/env python3
 
+#
+# BLEMBA scores from a BLOOM model served by transformers-bloom-inference (see 04-launch_server.sh).
+# The client can be tested without the model against the stand-in server with the same /generate/ schema:
+# ./metrics_domain_adaptation/scripts/11-bloom/06-stand_in_server.py --port 5000 --batch-capacity 8 &
+# ./metrics_domain_adaptation/scripts/11-bloom/05-inference.py --domain bio --langs en-de --mode src --batch-size 8
+#
+
 import argparse
 import json
-import requests
+import asyncio
 import numpy as np
 import tqdm
 import os
+from typing import Dict, List, Tuple
 from metrics_domain_adaptation import utils
+from metrics_domain_adaptation.metrics.llm_client import GenerateClient
+from metrics_domain_adaptation.metrics import cache, llm_cache
 
 URL = "http://127.0.0.1:5000"
 
@@ -58,47 +68,169 @@ def attempt_parse(x):
         return None
 
 
-def generate(lang1, lang2, src, tgt, ref, mode) -> None:
-    request_body = {
-        "text": [
-            PROMPTS[mode].format(
-                src=src, tgt=tgt, lang1=lang1, lang2=lang2,
-                **(dict(ref=ref) if mode == "ref" else {})
-            ),
-        ],
+def format_prompt(lang1, lang2, src, tgt, ref, mode) -> str:
+    return PROMPTS[mode].format(
+        src=src, tgt=tgt, lang1=lang1, lang2=lang2,
+        **(dict(ref=ref) if mode == "ref" else {})
+    )
+
+
+GENERATE_KWARGS = {
+    "sample": {
         "max_new_tokens": 1,
         "do_sample": True,
         "top_k": 100,
-    }
-    response = requests.post(
-        url=URL+"/generate/",
-        json=request_body, verify=False
-    )
-    response = response.json()["text"][0]
-    return response
+    },
+    # the server returns the log-probabilities of the top-k next tokens (see 06-stand_in_server.py)
+    "expected": {
+        "max_new_tokens": 1,
+        "do_sample": False,
+        "top_logprobs": 20,
+    },
+}
 
 
-def get_blemba_score(lang1, lang2, src, tgt, ref, mode) -> float:
-    outputs = []
+def expected_score(top_logprobs) -> float:
+    """
+    Probability-weighted average of the numeric tokens among the top-k next tokens, None if there are none.
+    """
+    values = []
+    probs = []
+    for token, logprob in top_logprobs.items():
+        value = attempt_parse(token)
+        if value is not None and 0 <= value <= 100:
+            values.append(value)
+            probs.append(np.exp(logprob))
+    if not values:
+        return None
+    return float(np.average(values, weights=probs))
+
+
+async def get_blemba_scores_expected(client, prompts) -> Tuple[List[float], List[List[Dict]]]:
+    """
+    Scores (None if there is no numeric token) and top-k next-token log-probabilities of a chunk of prompts.
+    """
+    outputs = await client.generate(prompts, field="top_logprobs", **GENERATE_KWARGS["expected"])
+    # log-probabilities of the first (and only) generated token
+    scores = [expected_score(output[0]) for output in outputs]
+    return scores, [[output[0]] for output in outputs]
+
+
+async def get_blemba_scores(client, prompts) -> Tuple[List[float], List[List[str]]]:
+    """
+    Scores and raw generations of a chunk of prompts, the ones which can not be parsed are sent again
+    and are scored None if all the attempts fail.
+    """
+    scores = [None] * len(prompts)
+    generations = [[] for _ in prompts]
+    pending = list(range(len(prompts)))
     # make at most 10 attempts
     for _ in range(10):
-        val = attempt_parse(generate(lang1, lang2, src, tgt, ref, mode))
-        if val is not None:
-            outputs.append(val)
-        if len(outputs) == 1:
+        outputs = await client.generate([prompts[i] for i in pending], **GENERATE_KWARGS["sample"])
+        for i, output in zip(pending, outputs):
+            generations[i].append(output)
+            scores[i] = attempt_parse(output)
+        pending = [i for i in pending if scores[i] is None]
+        if not pending:
             break
 
-    if outputs:
-        return np.average(outputs)
-    else:
+    return scores, generations
+
+
+async def get_blemba_scores_cached(client, prompts, decoding, response_cache, signature) -> List[float]:
+    """
+    Scores with the given decoding, only the prompts which are not in the response cache are sent.
+    Prompts whose response can not be parsed are scored 0 and are not cached so that later runs retry them.
+    """
+    get_scores = get_blemba_scores_expected if decoding == "expected" else get_blemba_scores
+    if response_cache is None:
+        scores = (await get_scores(client, prompts))[0]
+        return [0 if score is None else score for score in scores]
+
+    hashes = [llm_cache.hash_prompt(prompt) for prompt in prompts]
+    cached = response_cache.get_many(signature, hashes)
+    missing = [i for i, prompt_hash in enumerate(hashes) if prompt_hash not in cached]
+    if missing:
+        scores, generations = await get_scores(client, [prompts[i] for i in missing])
+        responses = {
+            hashes[i]: (generations_line, score)
+            for i, generations_line, score in zip(missing, generations, scores)
+        }
+        response_cache.put_many(signature, {
+            prompt_hash: response for prompt_hash, response in responses.items()
+            if response[1] is not None
+        })
+        cached |= responses
+    return [
+        0 if cached[prompt_hash][1] is None else cached[prompt_hash][1]
+        for prompt_hash in hashes
+    ]
+
+
+def read_log(fname_log, data) -> int:
+    """
+    Restores the scores from the write-ahead log and returns how many there were.
+    Entries for other data (e.g. changed test set) are ignored and an incomplete last line is cut off.
+    """
+    if not os.path.exists(fname_log):
         return 0
 
+    restored = 0
+    end = 0
+    with open(fname_log, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            line = json.loads(line)
+            line_data = data[line["i"]] if line["i"] < len(data) else None
+            if line_data is not None and line["hash"] == cache.hash_triplet(line_data["src"], line_data["tgt"], line_data["ref"]):
+                line_data["blemba_score"] = line["blemba_score"]
+                restored += 1
+    with open(fname_log, "ab") as f:
+        f.truncate(end)
+    return restored
+
+
+def compact_log(fname, fname_log, data):
+    """
+    Writes the canonical output file and removes the log.
+    The output is replaced atomically so that its existence means that it is complete.
+    """
+    with open(fname + ".tmp", "w") as f:
+        f.write("\n".join([
+            json.dumps(x, ensure_ascii=False) for x in data
+        ]))
+    os.replace(fname + ".tmp", fname)
+    os.remove(fname_log)
+
 
 args = argparse.ArgumentParser()
 args.add_argument("--domain", default="all")
 args.add_argument("--langs", default="all")
 args.add_argument("--mode", default="all")
 args.add_argument("--prefix", default="")
+args.add_argument("--url", default=URL)
+args.add_argument(
+    "--decoding", default="sample", choices=["sample", "expected"],
+    help="Parse a single sampled token (with up to 10 attempts) or take the expected score from the top-k next-token log-probabilities."
+)
+args.add_argument(
+    "--concurrency", type=int, default=4,
+    help="Number of requests in flight."
+)
+args.add_argument(
+    "--batch-size", type=int, default=8,
+    help="Number of prompts per request, should be at most MAX_BATCH_SIZE of the server."
+)
+args.add_argument(
+    "--model-id", default="bigscience/bloomz-mt",
+    help="Model served at --url, part of the response cache key together with the URL."
+)
+args.add_argument(
+    "--no-response-cache", action="store_true",
+    help="Do not reuse the responses stored in $ADAPTATION_ROOT/cache/llm/ (and do not store new ones)."
+)
 args = args.parse_args()
 
 if args.langs == "all":
@@ -116,39 +248,90 @@ if args.mode == "all":
 else:
     modes = [args.mode]
 
-for mode in modes:
-    for domain in domains:
-        os.makedirs(
-            f"computed/blemba/{args.prefix}{mode}/{domain}/", exist_ok=True)
-        for lang in langs:
-            print("Running", mode, domain, lang)
-
-            fname = f"computed/blemba/{args.prefix}{mode}/{domain}/{lang}.jsonl"
-            lang1, lang2 = lang.split("-")
-            lang1name = LANGUAGE_CODES[lang1]
-            lang2name = LANGUAGE_CODES[lang2]
-
-            if os.path.exists(fname):
-                print("Skipping", mode, domain, lang)
-                continue
-
-            data = utils.load_data(
-                kind="mqm", domain=domain,
-                langs=lang, split="test"
-            )
-
-            for line_i, line in enumerate(tqdm.tqdm(data)):
-                line["blemba_score"] = get_blemba_score(
-                    lang1name, lang2name,
-                    line["src"], line["tgt"], line["ref"],
-                    mode=mode
+
+async def main():
+    response_cache = None if args.no_response_cache else llm_cache.ResponseCache()
+    async with GenerateClient(args.url, concurrency=args.concurrency, batch_size=args.batch_size) as client:
+        if args.decoding == "expected":
+            # fail early, transformers-bloom-inference itself does not return the log-probabilities
+            response = await client.post({"text": ["Score (0-100): "]} | GENERATE_KWARGS["expected"])
+            if "top_logprobs" not in response:
+                raise Exception(
+                    f"The server at {args.url} does not support top-k log-probabilities "
+                    "(no `top_logprobs` in the response), use --decoding sample."
                 )
-                if line_i % 100 == 0 or line_i == len(data) - 1:
-                    with open(fname, "w") as f:
-                        f.write("\n".join([
-                            json.dumps(x, ensure_ascii=False) for x in data
-                        ]))
 
+        for mode in modes:
+            for domain in domains:
+                os.makedirs(
+                    f"computed/blemba/{args.prefix}{mode}/{domain}/", exist_ok=True)
+                for lang in langs:
+                    print("Running", mode, domain, lang)
+
+                    fname = f"computed/blemba/{args.prefix}{mode}/{domain}/{lang}.jsonl"
+                    lang1, lang2 = lang.split("-")
+                    lang1name = LANGUAGE_CODES[lang1]
+                    lang2name = LANGUAGE_CODES[lang2]
+
+                    if os.path.exists(fname):
+                        print("Skipping", mode, domain, lang)
+                        continue
+
+                    data = utils.load_data(
+                        kind="mqm", domain=domain,
+                        langs=lang, split="test"
+                    )
+
+                    # scored segments are appended to the log as they come so that the run can be resumed
+                    fname_log = fname + ".wal"
+                    restored = read_log(fname_log, data)
+                    if restored:
+                        print("Resuming from", fname_log, "with", restored, "scored segments")
+
+                    signature = llm_cache.hash_signature(
+                        model=f"{args.url}/{args.model_id}", template=mode, params=GENERATE_KWARGS[args.decoding],
+                    )
+
+                    # rows with the same prompt (e.g. the same output of several systems) are sent only once
+                    pending = {}
+                    for i, line in enumerate(data):
+                        if "blemba_score" not in line:
+                            prompt = format_prompt(lang1name, lang2name, line["src"], line["tgt"], line["ref"], mode)
+                            pending.setdefault(prompt, []).append(i)
+                    prompts = list(pending.keys())
+                    print("Prompts:", len(prompts), "unique out of", sum(len(rows) for rows in pending.values()))
+
+                    async def score_chunk(chunk):
+                        return chunk, await get_blemba_scores_cached(client, chunk, args.decoding, response_cache, signature)
+
+                    # all chunks are scheduled at once, the client limits how many are in flight
+                    chunks = [
+                        prompts[i:i+args.batch_size]
+                        for i in range(0, len(prompts), args.batch_size)
+                    ]
+                    progress = tqdm.tqdm(total=len(data), initial=len(data)-sum(len(rows) for rows in pending.values()))
+                    with open(fname_log, "a") as f_log:
+                        for task in asyncio.as_completed([score_chunk(chunk) for chunk in chunks]):
+                            chunk, scores = await task
+                            for prompt, score in zip(chunk, scores):
+                                for i in pending[prompt]:
+                                    data[i]["blemba_score"] = score
+                                    f_log.write(json.dumps({
+                                        "i": i,
+                                        "hash": cache.hash_triplet(data[i]["src"], data[i]["tgt"], data[i]["ref"]),
+                                        "blemba_score": score,
+                                    }) + "\n")
+                                progress.update(len(pending[prompt]))
+                            f_log.flush()
+                    progress.close()
+                    compact_log(fname, fname_log, data)
+
+    print(f"Sent {client.requests} requests ({client.retries} retries)")
+    if response_cache is not None:
+        print(f"Response cache: {response_cache.hits} hits, {response_cache.misses} misses")
+
+
+asyncio.run(main())
 
 # nohup ./metrics_domain_adaptation/scripts/11-bloom/06-inference.py --mode src-p3 --domain bio --langs en-de > logs/bio_src_p3.log &
 # nohup ./metrics_domain_adaptation/scripts/11-bloom/06-inference.py --mode src-p2 --domain bio --langs en-de > logs/bio_src_p2.log &
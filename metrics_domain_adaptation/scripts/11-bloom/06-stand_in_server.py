@@ -0,0 +1,119 @@
+
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#!/usr/bin/env python3
+
+#
+# Lightweight stand-in for the transformers-bloom-inference server (see 04-launch_server.sh)
+# with the same `/generate/` request/response schema, used to develop and test 05-inference.py without a model.
+# The outputs are deterministic: the score of a prompt is derived from its hash and with `top_logprobs`
+# the next-token log-probabilities are spread around it (plus a non-numeric token).
+# Latency, error rate and batch capacity are configurable for load testing (see 07-benchmark_client.py).
+#
+# ./metrics_domain_adaptation/scripts/11-bloom/06-stand_in_server.py --port 5000 &
+# ./metrics_domain_adaptation/scripts/11-bloom/05-inference.py --decoding expected --domain bio --langs en-de --mode src
+#
+
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+import numpy as np
+from aiohttp import web
+
+args = argparse.ArgumentParser()
+args.add_argument("--host", default="127.0.0.1")
+args.add_argument("--port", type=int, default=5000)
+args.add_argument(
+    "--latency", type=float, default=0.0,
+    help="Seconds per request (e.g. prefill) on top of --latency-per-prompt for each prompt in it."
+)
+args.add_argument("--latency-per-prompt", type=float, default=0.0)
+args.add_argument(
+    "--error-rate", type=float, default=0.0,
+    help="Fraction of requests which fail with HTTP 503."
+)
+args.add_argument(
+    "--batch-capacity", type=int, default=None,
+    help="Maximum number of prompts in a request (MAX_BATCH_SIZE of the real server), larger requests fail with HTTP 400."
+)
+args.add_argument(
+    "--workers", type=int, default=1,
+    help="Number of requests processed at the same time, the rest is queued (the real server has a single worker)."
+)
+args.add_argument("--seed", type=int, default=0)
+args = args.parse_args()
+
+# only the errors are random, the outputs depend only on the prompts
+errors_random = random.Random(args.seed)
+
+
+def prompt_score(prompt) -> int:
+    return int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16) % 101
+
+
+def prompt_top_logprobs(prompt, k) -> dict:
+    score = prompt_score(prompt)
+    # scores rounded to 5 close to the prompt score are the most likely, the rest goes to a non-numeric token
+    logits = {str(value): -abs(value - score) / 5 for value in range(0, 101, 5)}
+    logits[" The"] = -2.0
+    log_norm = np.log(np.sum(np.exp(list(logits.values()))))
+    top = sorted(logits.items(), key=lambda x: x[1], reverse=True)[:k]
+    return {token: float(logit - log_norm) for token, logit in top}
+
+
+query_id = 0
+model_lock = None
+
+
+async def generate(request):
+    global query_id, model_lock
+
+    time_start = time.perf_counter()
+    body = await request.json()
+    prompts = body["text"]
+    max_new_tokens = int(body.get("max_new_tokens", 1))
+    query_id += 1
+
+    if args.batch_capacity is not None and len(prompts) > args.batch_capacity:
+        return web.json_response(
+            {"error": f"batch size {len(prompts)} exceeds {args.batch_capacity}"}, status=400
+        )
+    if errors_random.random() < args.error_rate:
+        return web.json_response({"error": "stand-in failure"}, status=503)
+
+    if model_lock is None:
+        model_lock = asyncio.Semaphore(args.workers)
+    async with model_lock:
+        await asyncio.sleep(args.latency + args.latency_per_prompt * len(prompts))
+
+    response = {
+        "text": [str(prompt_score(prompt)) for prompt in prompts],
+        "num_generated_tokens": [1] * len(prompts),
+        "query_id": query_id,
+    }
+    if body.get("top_logprobs"):
+        # one dictionary for each generated token
+        response["top_logprobs"] = [
+            [prompt_top_logprobs(prompt, int(body["top_logprobs"]))] * max_new_tokens
+            for prompt in prompts
+        ]
+    response["total_time_taken"] = f"{time.perf_counter() - time_start:.2f} secs"
+    return web.json_response(response)
+
+
+app = web.Application()
+app.router.add_post("/generate/", generate)
+web.run_app(app, host=args.host, port=args.port)
@@ -0,0 +1,98 @@
+
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#!/usr/bin/env python3
+
+#
+# Measures the throughput and tail latency of the inference client (metrics/llm_client.py).
+# Without --url, the stand-in server (06-stand_in_server.py) is started with the remaining arguments, e.g.
+# ./metrics_domain_adaptation/scripts/11-bloom/07-benchmark_client.py --concurrency 8 --batch-size 8 --latency 0.2 --latency-per-prompt 0.02 --error-rate 0.01 --workers 2
+#
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+import numpy as np
+from metrics_domain_adaptation.metrics.llm_client import GenerateClient
+
+args = argparse.ArgumentParser()
+args.add_argument("--url", default=None)
+args.add_argument("--prompts", type=int, default=2000)
+args.add_argument("--prompt-length", type=int, default=100, help="Number of words in each prompt.")
+args.add_argument("--concurrency", type=int, default=4)
+args.add_argument("--batch-size", type=int, default=8)
+args.add_argument("--top-logprobs", type=int, default=None)
+args, args_server = args.parse_known_args()
+
+
+def wait_for_port(port, timeout=30):
+    time_start = time.time()
+    while time.time() - time_start < timeout:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception(f"The stand-in server did not start on port {port}")
+
+
+async def main(url):
+    prompts = [
+        " ".join(f"word{(i * 7 + j) % 1000}" for j in range(args.prompt_length))
+        for i in range(args.prompts)
+    ]
+    generate_kwargs = {"max_new_tokens": 1, "do_sample": True, "top_k": 100}
+    if args.top_logprobs:
+        generate_kwargs = {"max_new_tokens": 1, "do_sample": False, "top_logprobs": args.top_logprobs}
+
+    async with GenerateClient(url, concurrency=args.concurrency, batch_size=args.batch_size, backoff=0.1) as client:
+        time_start = time.perf_counter()
+        await client.generate(prompts, **generate_kwargs)
+        time_total = time.perf_counter() - time_start
+
+    latencies = np.array(client.latencies) * 1000
+    print(
+        f"{args.prompts} prompts in {client.requests} requests ({client.retries} retries) in {time_total:.2f}s: "
+        f"{args.prompts / time_total:.1f} prompts/s, {client.requests / time_total:.1f} requests/s"
+    )
+    # latencies of the successful requests, including the time waiting in the server queue
+    print(
+        "Request latency (ms): " +
+        ", ".join(f"p{p} {np.percentile(latencies, p):.1f}" for p in [50, 90, 99]) +
+        f", max {latencies.max():.1f}"
+    )
+
+
+if args.url is None:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen([
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "06-stand_in_server.py"),
+        "--port", str(port), *args_server,
+    ], stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        asyncio.run(main(f"http://127.0.0.1:{port}"))
+    finally:
+        server.terminate()
+        server.wait()
+else:
+    if args_server:
+        raise Exception(f"Unknown arguments {args_server} (only used to start the stand-in server without --url)")
+    asyncio.run(main(args.url))
@@ -118,6 +118,13 @@ def pretty_langs(langs: str) -> str:
     return lang1.capitalize() + "-" + lang2.capitalize()
 
 
+def parse_bool(value) -> bool:
+    """
+    Flags such as metric kwargs may come as strings from the command line.
+    """
+    return str(value).lower() in {"1", "true", "yes"}
+
+
 def get_score_google(category, severity):
     """
     Taken from Table 2 in https://aclanthology.org/2021.wmt-1.73v3.pdf